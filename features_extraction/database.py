@@ -5,8 +5,13 @@ IEMOCAP/EMODB/RAVDESS/MELD
 ref:https://github.com/Vincent-ZHQ/CA-MSER
 '''
 import os
+import json
+import hashlib
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import pandas as pd
+import soundfile as sf
 import ffmpeg
 from pathlib import Path
 
@@ -84,131 +89,91 @@ class IEMOCAP_Database():
         
         return classes
     
-    def get_files(self):
+    @staticmethod
+    def parse_label_file(label_path):
+        '''
+        解析一个EmoEvaluation标签文件，只取每句的汇总行：
+        [6.2901 - 8.2357]	Ses01F_impro01_F000	neu	[2.5000, 2.5000, 2.5000]
+        返回字典：语句名 -> 情感，eg. Ses01F_impro01_F000 -> neu
+        '''
+        labels = {}
+        with open(label_path, "r") as fin:
+            for line in fin:
+                if line[0] == "[":
+                    t = line.split()
+                    labels[t[3]] = t[4]
+        return labels
+
+    def index_session(self, session_name):
+        '''
+        索引一个Session：一次解析EmoEvaluation下的所有标签文件得到一张标签表，
+        再遍历一次sentences/wav目录，与标签表连接。
+        返回(男性音频列表, 女性音频列表)，元素为(.wav filepath, label)，
+        顺序与目录遍历顺序一致。没有可用对话时返回None。
+        '''
+        emotions = self.emotions_map.keys()
+        wav_dir = os.path.join(self.database_dir, session_name, 'sentences/wav')
+        label_dir = os.path.join(self.database_dir, session_name, 'dialog/EmoEvaluation')
+
+        #对话文件夹。不包含scripted时只要impro开头的。
+        conversations = [c for c in os.listdir(wav_dir)
+                         if self.include_scripted or c[7:12] == "impro"]
+        if not conversations:
+            return None
+
+        #标签表：语句名 -> 情感，每个标签文件只读一次。
+        labels = {}
+        for conversation_folder in conversations:
+            labels.update(self.parse_label_file(os.path.join(label_dir, conversation_folder + '.txt')))
+
+        #分男女存储，根据文件名判断男女，eg. Ses01F_impro01_F000.wav
+        M_wav, F_wav = [], []
+        for conversation_folder in conversations:
+            conversation_dir = os.path.join(wav_dir, conversation_folder)
+            for wav_name in os.listdir(conversation_dir):
+                name, ext = os.path.splitext(wav_name)
+                if ext != '.wav':
+                    continue
+                emotion = labels[name]
+                if emotion not in emotions:
+                    continue
+                wav_path = os.path.join(conversation_dir, wav_name)
+                if wav_path[-8] == "F":
+                    F_wav.append((wav_path, self.emotions_map[emotion]))
+                elif wav_path[-8] == "M":
+                    M_wav.append((wav_path, self.emotions_map[emotion]))
+        return M_wav, F_wav
+
+    def get_files(self, num_threads=5):
         '''
         获取数据集中的音频文件，将音频文件与speaker_id进行映射。
+        各Session用线程池并行索引，每个Session的标签文件只解析一次。
         返回一个字典：
         keys->speaker ID
         values->音频文件列表(.wav filepath, label) 元组 一个人可能有好多句。
         '''
-        
-        #取得情感。
-        emotions = self.emotions_map.keys()
-        dataset_dir = self.database_dir
-        all_speaker_files = defaultdict(list) #定义一个字典，值是列表形式。
-        total_num_files = 0
-
-        #开始遍历。遍历文件目录下的所有session文件夹。
         '''
         目录格式：
         G:/Datasets/IEMOCAP/
             Session1/
-            Session2/
-            Session3/
-            Session4/
+                sentences/wav/<对话>/<语句>.wav
+                dialog/EmoEvaluation/<对话>.txt
+            ...
             Session5/
         '''
-        for session_name in os.listdir(dataset_dir):
-            
-            #如果list的文件夹里不是Session1-5，就跳过。
-            if session_name not in self.sessions:
-                continue
-            '''
-            eg.Datasets\IEMOCAP\Session1\sentences\wav
-            wav里是一堆对话文件夹，对话文件里面是wav音频。
-            '''
-            wav_dir = os.path.join(dataset_dir,session_name,'sentences/wav')
-            '''
-            eg.Datasets\IEMOCAP\Session1\dialog\EmoEvaluation
-            该文件夹是一堆情感文件txt，等后期再遍历。
-            '''
-            label_dir = os.path.join(dataset_dir,session_name,'dialog/EmoEvaluation')
-
-            #接下来开始分男女。
-            M_wav , F_wav= [],[] #定义男女说话人文件夹列表。
-            for conversation_folder in os.listdir(wav_dir):
-                #遍历wav文件夹下的对话文件夹。
-                # if conversation_folder.startswith('.'):
-                #     continue
-                if self.include_scripted == False:
-                    #排除scripted数据。只使用即兴数据。对文件夹名进行处理。
-                    #只要文件夹为impro开头的。如果为False就不处理scripted数据。
-                    #循环跳过这里走下一个。
-                    if conversation_folder[7:12] != "impro":
-                        continue
-                
-                #拼wav.文件地址。
-                '''
-                eg.Datasets\IEMOCAP\Session1\sentences\wav\Ses01F_impro01_F000
-                能一直引到文件夹。
-                '''
-                conversation_dir = os.path.join(wav_dir,conversation_folder)
-
-                #获得标签的地址。
-                '''
-                eg.Datasets\IEMOCAP\Session1\dialog\EmoEvaluation\Ses01F_impro01.txt
-                每个语段都对应着txt。 相当于一个同名对话文件夹对应一个同名.txt，对话文件夹
-                里对应着这个对话的所有wav.
-                '''
-                label_path=os.path.join(label_dir,conversation_folder+'.txt')
-                #进行标签提取。
-                labels={}
-                with open(label_path,"r") as fin:
-                    for line in fin: #逐行读取txt文件。
-                        '''
-                        [6.2901 - 8.2357]	Ses01F_impro01_F000	neu	[2.5000, 2.5000, 2.5000]
-                        C-E2:	Neutral;	()
-                        C-E3:	Neutral;	()
-                        C-E4:	Neutral;	()
-                        C-F1:	Neutral;	(curious)
-                        A-E3:	val 3; act 2; dom  2;	()
-                        A-E4:	val 2; act 3; dom  3;	(mildly aggravated but staying polite, attitude)
-                        A-F1:	val 3; act 2; dom  1;	()
-
-                        [10.0100 - 11.3925]	Ses01F_impro01_F001	neu	[2.5000, 2.5000, 2.5000]
-                        C-E2:	Neutral;	()
-                        C-E3:	Neutral;	()
-                        C-E4:	Neutral;	()
-                        C-F1:	Neutral; Anger;	()
-                        A-E3:	val 3; act 2; dom  2;	()
-                        A-E4:	val 2; act 3; dom  3;	(guarded, tense, ready)
-                        A-F1:	val 2; act 3; dom  2;	()
-                        只需要提取neu。
-                        '''
-                        if line[0]=="[":
-                            t=line.split() #将句子按空格分隔。
-                            #建立映射：
-                            # Ses01F_impro01_F000 neu
-                            # Ses01F_impro01_F001 neu
-                            labels[t[3]]= t[4]
-                #接下来开始建立音频映射。
-                wav_files=[]
-                for wav_name in os.listdir(conversation_dir):
-                    #遍历对话文件夹下的所有wav音频文件。
-                    #异常检测。
-                    # if wav_name.startswith('.'):
-                    #     continue
-                    name, ext = os.path.splitext(wav_name) #名字/后缀名。
-                    if ext != '.wav':
-                        continue
-                    emotion=labels[name] #通过映射获得情感标签。
-                    if emotion not in emotions:
-                        continue
+        sessions = [s for s in os.listdir(self.database_dir) if s in self.sessions]
+        with ThreadPoolExecutor(max_workers=num_threads) as pool:
+            indexed = list(pool.map(self.index_session, sessions))
 
-                    label=self.emotions_map[emotion] #label通过映射只剩0，1，2，3
-                    
-                    #wav_name包含后缀名。 “（文件路径,label）”
-                    wav_files.append((os.path.join(conversation_dir,wav_name),label))
-                
-                #分男女存储。遍历wav_files，根据文件名判断男女。wav_files是元组，所以要遍历第0项的字母。
-                F_wav.extend([emo_wav for emo_wav in wav_files if emo_wav[0][-8] == "F"])
-                M_wav.extend([emo_wav for emo_wav in wav_files if emo_wav[0][-8] == "M"])
-
-                #统计文件数量。1F里面是（文件名，label）
-                all_speaker_files[self.get_speaker_id(session_name,"M")] = M_wav
-                all_speaker_files[self.get_speaker_id(session_name,"F")] = F_wav
+        all_speaker_files = defaultdict(list)
+        for session_name, files in zip(sessions, indexed):
+            if files is None:
+                continue
+            M_wav, F_wav = files
+            all_speaker_files[self.get_speaker_id(session_name, "M")] = M_wav
+            all_speaker_files[self.get_speaker_id(session_name, "F")] = F_wav
 
-                total_num_files += len(M_wav) + len(F_wav)
+        total_num_files = sum(len(files) for files in all_speaker_files.values())
         print(f"IEMOCAP Database: Total number of files: {total_num_files}")
         return all_speaker_files
 
@@ -440,6 +405,11 @@ class MELD_Database():
         # 新增：定义test样本的数量阈值
         self.test_sample_threshold = 548  
 
+        # 每条语音的文本（Utterance列），wav_path -> text，在get_files中填充
+        self.utterance_text = {}
+        # 每条语音来自的官方划分（train/dev/test，即所在的CSV），在get_files中填充
+        self.utterance_split = {}
+
 
     def get_speaker_id_train_test(self,wav_dir):
         '''
@@ -461,6 +431,20 @@ class MELD_Database():
         # else:
         #     return str("test")
     
+    def get_split(self,wav_path):
+        '''
+        官方划分：返回train/dev/test。
+        get_files读过的文件按其来源CSV划分；其余按所在文件夹划分（只比较规范化的路径，不访问文件系统）。
+        '''
+        if wav_path in self.utterance_split:
+            return self.utterance_split[wav_path]
+        audio_dir = os.path.normcase(os.path.abspath(os.path.dirname(wav_path)))
+        if audio_dir == os.path.normcase(os.path.abspath(self.audio_train)):
+            return "train"
+        if audio_dir == os.path.normcase(os.path.abspath(self.audio_dev)):
+            return "dev"
+        return "test"
+
     def get_speaker_id(self,speaker):
         """
         判断输入的speaker是否为核心人物，非核心人物返回'others'
@@ -499,9 +483,11 @@ class MELD_Database():
 
         # 重置计数器（每次调用get_files时重新计数，避免累计）
         self.speaker_count = 0
+        self.utterance_text = {}
+        self.utterance_split = {}
 
-        #读取csv文件。
-        def load_csv(csv_path,audio_dir):
+        #读取csv文件。split: 该CSV对应的官方划分。
+        def load_csv(csv_path,audio_dir,split):
             df = pd.read_csv(csv_path) #读取csv
             '''CSV文件构造：
             Sr No.	Utterance	Speaker	Emotion	Sentiment	Dialogue_ID	Utterance_ID	Season	Episode	StartTime	EndTime
@@ -535,6 +521,8 @@ class MELD_Database():
                 # 调用计数版的get_speaker_id
                 speaker_id = self.get_speaker_id(speaker)
                 all_speaker_files[speaker_id].append((wav_path,label))
+                self.utterance_text[wav_path] = str(row["Utterance"])
+                self.utterance_split[wav_path] = split
             
         failed_files = []  # 记录失败文件列表
 
@@ -598,9 +586,9 @@ class MELD_Database():
         # batch_convert_mp4_to_wav(self.audio_train)
         # batch_convert_mp4_to_wav(self.audio_dev)
         # batch_convert_mp4_to_wav(self.audio_test)
-        load_csv(self.csv_train, self.audio_train)
-        load_csv(self.csv_dev,self.audio_dev)
-        load_csv(self.csv_test, self.audio_test)
+        load_csv(self.csv_train, self.audio_train, "train")
+        load_csv(self.csv_dev,self.audio_dev, "dev")
+        load_csv(self.csv_test, self.audio_test, "test")
         
         # 新增：打印计数统计，验证逻辑是否生效
         print(f"总计样本数：{self.speaker_count}")
@@ -613,6 +601,153 @@ class MELD_Database():
 
 
 
+def get_durations(speaker_files, cache_path=None):
+    '''
+    读取所有音频的长度，只读WAV文件头，不解码音频。
+    speaker_files: get_files()的返回值。
+    cache_path: 索引缓存的json路径。文件大小和修改时间不变的条目直接复用。
+    返回字典：wav_path -> (采样点数, 采样率)
+    '''
+    cache = {}
+    if cache_path is not None and os.path.isfile(cache_path):
+        with open(cache_path, "r", encoding="utf-8") as fin:
+            cache = json.load(fin)
+
+    durations = {}
+    updated = False
+    for speaker_id in speaker_files:
+        for wav_path, _ in speaker_files[speaker_id]:
+            stat = os.stat(wav_path)
+            entry = cache.get(wav_path)
+            if entry is None or entry["size"] != stat.st_size or entry["mtime"] != stat.st_mtime:
+                info = sf.info(wav_path)
+                entry = {"size": stat.st_size, "mtime": stat.st_mtime,
+                         "frames": info.frames, "sr": info.samplerate}
+                cache[wav_path] = entry
+                updated = True
+            durations[wav_path] = (entry["frames"], entry["sr"])
+
+    if cache_path is not None and updated:
+        with open(cache_path, "w", encoding="utf-8") as fout:
+            json.dump(cache, fout)
+
+    return durations
+
+
+def spectral_fingerprint(x, sr, frame_ms=100, num_bands=17):
+    '''
+    粗粒度频谱指纹：每100ms一帧、对数间隔的频带能量，取相邻频带能量差在时间上的
+    变化符号作为比特（与增益无关，对轻微的编码差异不敏感），再求哈希。
+    '''
+    frame = int(sr * frame_ms / 1000)
+    num_frames = len(x) // frame
+    if num_frames < 2:
+        return None
+    spec = np.abs(np.fft.rfft(x[:num_frames * frame].reshape(num_frames, frame), axis=1)) ** 2
+    edges = np.unique(np.geomspace(1, spec.shape[1], num_bands + 1).astype(int))
+    energy = np.log(np.add.reduceat(spec, edges[:-1], axis=1) + 1e-10)
+    bits = np.diff(np.diff(energy, axis=1), axis=0) > 0
+    return hashlib.sha1(np.packbits(bits).tobytes()).hexdigest()
+
+
+def _fingerprint(wav_path, spectral):
+    x, sr = sf.read(wav_path, dtype='float32', always_2d=True)
+    h = hashlib.sha1(f'{sr}|{x.shape}|'.encode('utf-8'))
+    h.update(np.ascontiguousarray(x).tobytes())
+    entry = {'pcm': h.hexdigest()}
+    if spectral:
+        entry['spec'] = spectral_fingerprint(x.mean(axis=1), sr)
+    return entry
+
+
+def get_fingerprints(speaker_files, cache_path=None, spectral=False, num_threads=8):
+    '''
+    计算所有音频的指纹，用于查找重复的音频。
+    pcm: 解码后PCM（含采样率和形状）的sha1，完全相同的音频才相同。
+    spec: 可选的粗粒度频谱指纹（spectral=True），近似相同的音频也相同。
+    cache_path: 与get_durations相同的索引缓存，文件大小和修改时间不变的条目直接复用。
+    多线程解码。返回字典：wav_path -> {'pcm': ..., 'spec': ...}
+    '''
+    cache = {}
+    if cache_path is not None and os.path.isfile(cache_path):
+        with open(cache_path, "r", encoding="utf-8") as fin:
+            cache = json.load(fin)
+
+    stats, todo = {}, []
+    for speaker_id in speaker_files:
+        for wav_path, _ in speaker_files[speaker_id]:
+            stats[wav_path] = os.stat(wav_path)
+            entry = cache.get(wav_path)
+            if (entry is None or entry["size"] != stats[wav_path].st_size
+                    or entry["mtime"] != stats[wav_path].st_mtime
+                    or "pcm" not in entry or (spectral and "spec" not in entry)):
+                todo.append(wav_path)
+
+    with ThreadPoolExecutor(max_workers=num_threads) as pool:
+        for wav_path, fingerprint in zip(todo, pool.map(lambda p: _fingerprint(p, spectral), todo)):
+            entry = cache.get(wav_path, {})
+            if entry.get("size") != stats[wav_path].st_size or entry.get("mtime") != stats[wav_path].st_mtime:
+                info = sf.info(wav_path)
+                entry = {"size": stats[wav_path].st_size, "mtime": stats[wav_path].st_mtime,
+                         "frames": info.frames, "sr": info.samplerate}
+            entry.update(fingerprint)
+            cache[wav_path] = entry
+
+    if cache_path is not None and todo:
+        with open(cache_path, "w", encoding="utf-8") as fout:
+            json.dump(cache, fout)
+
+    return {wav_path: {"pcm": cache[wav_path]["pcm"], "spec": cache[wav_path].get("spec")}
+            for wav_path in stats}
+
+
+def find_duplicates(speaker_files, fingerprints, durations, spectral=False):
+    '''
+    按指纹把音频分组。每组只提取第一次出现（按speaker_files顺序）的音频，其余引用它。
+    spectral=True时频谱指纹相同、且采样点数和采样率相同的音频也视为重复。
+    返回 (duplicates, report)：
+        duplicates: 重复音频路径 -> 第一次出现的音频路径
+        report: 重复组、重复文件数以及节省的音频时长
+    '''
+    first, duplicates, groups = {}, {}, defaultdict(list)
+    for speaker_id in speaker_files:
+        for wav_path, _ in speaker_files[speaker_id]:
+            fingerprint = fingerprints[wav_path]
+            keys = [("pcm", fingerprint["pcm"])]
+            if spectral and fingerprint.get("spec") is not None:
+                keys.append(("spec", fingerprint["spec"], tuple(durations[wav_path])))
+            canonical = next((first[k] for k in keys if k in first), None)
+            if canonical is None:
+                for k in keys:
+                    first[k] = wav_path
+            else:
+                duplicates[wav_path] = canonical
+                groups[canonical].append(wav_path)
+
+    paths = [wav_path for speaker_id in speaker_files for wav_path, _ in speaker_files[speaker_id]]
+    total = sum(durations[p][0] / durations[p][1] for p in paths)
+    saved = sum(durations[p][0] / durations[p][1] for p in duplicates)
+    report = {"num_files": len(paths),
+              "num_groups": len(groups),
+              "num_duplicates": len(duplicates),
+              "audio_seconds": total,
+              "saved_seconds": saved,
+              "saved_fraction": saved / total if total else 0.0,
+              "groups": {canonical: paths for canonical, paths in groups.items()}}
+    return duplicates, report
+
+
+def get_speaker_texts(database, speaker_files):
+    '''
+    每个说话人的语音文本列表，顺序与speaker_files（即utter_label）一致。
+    只有记录了utterance_text的数据集（MELD）可用。
+    '''
+    if not hasattr(database, 'utterance_text'):
+        raise ValueError(type(database).__name__ + ' has no utterance texts, only MELD can be used for text features')
+    return {speaker_id: [database.utterance_text[wav_path] for wav_path, _ in speaker_files[speaker_id]]
+            for speaker_id in speaker_files}
+
+
 #负责后续调用。
 SER_DATABASES = {'IEMOCAP': IEMOCAP_Database,
                  'EMODB': EMODB_Database,
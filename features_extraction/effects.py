@@ -0,0 +1,166 @@
+'''
+Author: Shihe Dong
+Description: In-process audio effects for data augmentation.
+Chainable like pysndfx.AudioEffectsChain, with the same positional arguments
+and defaults for the effects below and for calling the chain
+(src, dst=np.ndarray, sample_in=44100, sample_out=None, channels_out=None,
+allow_clipping=True), but runs on NumPy arrays in the current process (no sox
+subprocess per call) and on batches of signals.
+Not supported: file paths as input/output, channels_out other than 1, and the
+sox tuning arguments of pitch/tempo (use_tree, segment, search, overlap).
+
+eg.
+    fx = AudioEffectsChain().highpass(100).reverb(50).gain(-3)
+    y = fx(x, sample_in=16000)          # x: (n,) or (batch, n)
+'''
+import functools
+import numpy as np
+import scipy.signal
+import librosa
+
+
+def _biquad(kind, frequency, q, sr):
+    '''
+    RBJ audio-EQ-cookbook biquad, the same filters as sox lowpass/highpass/bandpass.
+    '''
+    w0 = 2 * np.pi * frequency / sr
+    alpha = np.sin(w0) / (2 * q)
+    cos_w0 = np.cos(w0)
+    if kind == 'lowpass':
+        b = [(1 - cos_w0) / 2, 1 - cos_w0, (1 - cos_w0) / 2]
+    elif kind == 'highpass':
+        b = [(1 + cos_w0) / 2, -(1 + cos_w0), (1 + cos_w0) / 2]
+    elif kind == 'bandpass':
+        # constant 0 dB peak gain
+        b = [alpha, 0.0, -alpha]
+    else:
+        raise ValueError(f'Unknown filter <{kind}>')
+    a = [1 + alpha, -2 * cos_w0, 1 - alpha]
+    return np.asarray(b) / a[0], np.asarray(a) / a[0]
+
+
+@functools.lru_cache(maxsize=32)
+def reverb_impulse_response(sr, reverberance=50, room_scale=100, hf_damping=50, pre_delay=20):
+    '''
+    Synthetic room impulse response: pre-delay, then exponentially decaying noise.
+    Cached, so a chain applied to many utterances builds it only once.
+
+    reverberance (0-100) and room_scale (0-100) set the decay time (RT60),
+    hf_damping (0-100) low-passes the tail, pre_delay is in ms.
+    '''
+    rt60 = (0.1 + 1.9 * reverberance / 100) * (0.2 + 0.8 * room_scale / 100)
+    length = int(rt60 * sr)
+    t = np.arange(length) / sr
+    # Fixed seed: the response only depends on the parameters
+    tail = np.random.default_rng(0).standard_normal(length) * 10 ** (-3 * t / rt60)
+    if hf_damping > 0:
+        coef = 0.95 * hf_damping / 100
+        tail = scipy.signal.lfilter([1 - coef], [1, -coef], tail)
+    ir = np.concatenate([np.zeros(int(pre_delay / 1000 * sr)), tail])
+    ir /= np.sqrt(np.sum(ir ** 2))
+    ir.setflags(write=False)
+    return ir
+
+
+class AudioEffectsChain():
+    '''
+    Chain of effects applied along the last axis of a signal or a batch of signals.
+    Each method appends an effect and returns the chain.
+    '''
+    def __init__(self):
+        self.command = []
+
+    def gain(self, db):
+        self.command.append(('gain', {'db': db}))
+        return self
+
+    def reverb(self, reverberance=50, hf_damping=50, room_scale=100, stereo_depth=100,
+               pre_delay=20, wet_gain=0, wet_only=False):
+        '''
+        stereo_depth is accepted for compatibility with pysndfx and has no effect:
+        the signals are mono.
+        '''
+        self.command.append(('reverb', {'reverberance': reverberance, 'hf_damping': hf_damping,
+                                        'room_scale': room_scale, 'pre_delay': pre_delay,
+                                        'wet_gain': wet_gain, 'wet_only': wet_only}))
+        return self
+
+    def pitch(self, shift):
+        '''
+        Pitch shift in cents, duration unchanged.
+        '''
+        self.command.append(('pitch', {'shift': shift}))
+        return self
+
+    def tempo(self, factor):
+        '''
+        Tempo change by <factor>, pitch unchanged.
+        '''
+        self.command.append(('tempo', {'factor': factor}))
+        return self
+
+    def speed(self, factor):
+        '''
+        Speed change by <factor>, changing both pitch and tempo.
+        '''
+        self.command.append(('speed', {'factor': factor}))
+        return self
+
+    def lowpass(self, frequency, q=0.707):
+        self.command.append(('lowpass', {'frequency': frequency, 'q': q}))
+        return self
+
+    def highpass(self, frequency, q=0.707):
+        self.command.append(('highpass', {'frequency': frequency, 'q': q}))
+        return self
+
+    def bandpass(self, frequency, q=1.0):
+        self.command.append(('bandpass', {'frequency': frequency, 'q': q}))
+        return self
+
+    def bandlimit(self, low, high):
+        '''
+        Keep the band [low, high] Hz, eg. bandlimit(300, 3400) for telephone audio.
+        '''
+        return self.highpass(low).lowpass(high)
+
+    def __call__(self, x, dst=np.ndarray, sample_in=44100, sample_out=None, channels_out=None,
+                 allow_clipping=True):
+        '''
+        Apply the chain to <x> and return the result as an array.
+        dst must be np.ndarray (no output files); sample_out resamples the result;
+        allow_clipping=False scales the result down so that its peak does not exceed 1,
+        like the sox guard.
+        '''
+        if dst is not np.ndarray:
+            raise ValueError('AudioEffectsChain only returns arrays: dst must be np.ndarray')
+        if channels_out not in (None, 1):
+            raise ValueError(f'AudioEffectsChain processes mono signals, got channels_out={channels_out}')
+        sr = sample_in
+        dtype = x.dtype
+        y = np.asarray(x, dtype=np.float64)
+        for name, args in self.command:
+            if name == 'gain':
+                y = y * 10 ** (args['db'] / 20)
+            elif name == 'reverb':
+                ir = reverb_impulse_response(sr, args['reverberance'], args['room_scale'],
+                                             args['hf_damping'], args['pre_delay'])
+                ir = ir.reshape((1,) * (y.ndim - 1) + (-1,))
+                wet = scipy.signal.fftconvolve(y, ir, axes=-1)[..., :y.shape[-1]]
+                wet = wet * 10 ** (args['wet_gain'] / 20)
+                y = wet if args['wet_only'] else y + wet
+            elif name == 'pitch':
+                y = librosa.effects.pitch_shift(y, sr=sr, n_steps=args['shift'] / 100)
+            elif name == 'tempo':
+                y = librosa.effects.time_stretch(y, rate=args['factor'])
+            elif name == 'speed':
+                y = librosa.resample(y, orig_sr=sr, target_sr=int(round(sr / args['factor'])))
+            elif name in ('lowpass', 'highpass', 'bandpass'):
+                b, a = _biquad(name, args['frequency'], args['q'], sr)
+                y = scipy.signal.lfilter(b, a, y, axis=-1)
+        if sample_out is not None and sample_out != sr:
+            y = librosa.resample(y, orig_sr=sr, target_sr=sample_out)
+        if not allow_clipping:
+            peak = np.max(np.abs(y), axis=-1, keepdims=True)
+            y = y / np.maximum(peak, 1.0)
+        return y.astype(dtype)
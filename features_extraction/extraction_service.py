@@ -0,0 +1,289 @@
+'''
+Author: Shihe Dong
+Description: Local feature extraction service.
+Keeps the processor and filterbanks of FEATURE_BANK warm in one long-running
+process and serves segmented features over HTTP on localhost.
+
+    python extraction_service.py --port 8765 --features logspec
+
+    POST /extract            body: audio file bytes (wav/flac/...), or JSON {"path": ..., "emotion": ...}
+                             returns an .npz with seg_spec, seg_mfcc, seg_audio, seg_num
+    GET  /metrics            request latency, queue depth and batch sizes (JSON)
+    GET  /health
+
+Concurrent requests are micro-batched: the batch thread takes up to --batch_size
+queued requests, waiting at most --max_wait_ms for more after the first one.
+'''
+import io
+import sys
+import json
+import time
+import queue
+import argparse
+import threading
+import urllib.request
+from collections import deque
+from concurrent.futures import Future
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import numpy as np
+import soundfile as sf
+
+from features_util import FEATURE_BANK, load_audio, extract_utterance, utterance_rng
+
+
+def decode_audio(data):
+    '''
+    Decode audio file bytes at their native sampling rate, mixed down to mono
+    like librosa.load(sr=None).
+    '''
+    x, sr = sf.read(io.BytesIO(data), dtype='float32', always_2d=True)
+    return x.mean(axis=1), sr
+
+
+class MicroBatcher():
+    '''
+    Queue of requests processed in batches by one background thread.
+    process_batch(items) returns one result per item.
+    '''
+    def __init__(self, process_batch, batch_size=8, max_wait_ms=5.0):
+        self.process_batch = process_batch
+        self.batch_size = batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._loop, daemon=True)
+        self.thread.start()
+
+    def submit(self, item):
+        future = Future()
+        self.queue.put((item, future))
+        return future
+
+    def depth(self):
+        return self.queue.qsize()
+
+    def _loop(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.perf_counter() + self.max_wait
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            items = [item for item, _ in batch]
+            try:
+                results = self.process_batch(items)
+            except Exception:
+                # One bad request must not fail the others: retry one by one
+                results = []
+                for item in items:
+                    try:
+                        results.extend(self.process_batch([item]))
+                    except Exception as e:
+                        results.append(e)
+            for (_, future), result in zip(batch, results):
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+
+
+class ServiceMetrics():
+    '''
+    Thread-safe counters and the latencies of the last <window> requests.
+    '''
+    def __init__(self, window=1000):
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.requests, self.errors, self.audio_seconds = 0, 0, 0.0
+        self.latencies = deque(maxlen=window)
+        self.queue_depths = deque(maxlen=window)
+        self.batch_sizes = deque(maxlen=window)
+
+    def record_request(self, latency, audio_seconds=0.0, error=False):
+        with self.lock:
+            self.requests += 1
+            self.errors += int(error)
+            self.audio_seconds += audio_seconds
+            self.latencies.append(latency)
+
+    def record_batch(self, size, depth):
+        with self.lock:
+            self.batch_sizes.append(size)
+            self.queue_depths.append(depth)
+
+    def summary(self, depth):
+        with self.lock:
+            latencies = np.asarray(self.latencies) * 1000
+            percentiles = ({f'p{q}': float(np.percentile(latencies, q)) for q in (50, 95, 99)}
+                           if len(latencies) else {})
+            return {'uptime_s': time.time() - self.start,
+                    'requests': self.requests,
+                    'errors': self.errors,
+                    'audio_seconds': self.audio_seconds,
+                    'queue_depth': depth,
+                    'mean_queue_depth': float(np.mean(self.queue_depths)) if self.queue_depths else 0.0,
+                    'mean_batch_size': float(np.mean(self.batch_sizes)) if self.batch_sizes else 0.0,
+                    'latency_ms': {'mean': float(latencies.mean()) if len(latencies) else 0.0,
+                                   'max': float(latencies.max()) if len(latencies) else 0.0,
+                                   **percentiles}}
+
+
+class FeatureService():
+    '''
+    Extraction with a warm FEATURE_BANK, fed by a MicroBatcher.
+    With params['backend'] == 'torch', the utterances of a batch with the same
+    sampling rate go through torch_backend.extract_batch in one call.
+    '''
+    def __init__(self, features, params, srs=(16000,), batch_size=8, max_wait_ms=5.0):
+        self.features = features
+        self.params = params
+        self.metrics = ServiceMetrics()
+        FEATURE_BANK.build(set(srs), features, params)
+        FEATURE_BANK.processor()
+        self.batcher = MicroBatcher(self._process, batch_size, max_wait_ms)
+
+    def _process(self, items):
+        self.metrics.record_batch(len(items), self.batcher.depth())
+        if self.params.get('backend', 'librosa') == 'torch':
+            from torch_backend import extract_batch
+            results = [None] * len(items)
+            for sr in {sr for _, sr, _, _ in items}:
+                idx = [i for i, item in enumerate(items) if item[1] == sr]
+                batch = extract_batch([items[i][0] for i in idx], sr, [items[i][2] for i in idx],
+                                      self.features, self.params, rngs=[items[i][3] for i in idx])
+                for i, result in zip(idx, batch):
+                    results[i] = result
+            return results
+        return [extract_utterance(x, sr, emotion, self.features, self.params, rng=rng)
+                for x, sr, emotion, rng in items]
+
+    def extract(self, x, sr, emotion=0, name='request'):
+        '''
+        Segmented features of one utterance, blocking until its batch is done.
+        '''
+        rng = utterance_rng(name, self.params.get('seed', 111))
+        return self.batcher.submit((x, sr, emotion, rng)).result()
+
+
+def to_npz(result):
+    num_segs, seg_spec, _, _, seg_mfcc, seg_audio = result
+    buf = io.BytesIO()
+    np.savez(buf, seg_spec=seg_spec, seg_mfcc=seg_mfcc, seg_audio=seg_audio,
+             seg_num=np.asarray([num_segs], dtype=np.int32))
+    return buf.getvalue()
+
+
+def make_handler(service):
+    class Handler(BaseHTTPRequestHandler):
+        def _send(self, code, body, content_type='application/json'):
+            self.send_response(code)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == '/metrics':
+                self._send(200, json.dumps(service.metrics.summary(service.batcher.depth())).encode('utf-8'))
+            elif self.path == '/health':
+                self._send(200, b'{"status": "ok"}')
+            else:
+                self._send(404, b'{"error": "not found"}')
+
+        def do_POST(self):
+            if self.path != '/extract':
+                self._send(404, b'{"error": "not found"}')
+                return
+            t0 = time.perf_counter()
+            seconds = 0.0
+            try:
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                if self.headers.get('Content-Type', '').startswith('application/json'):
+                    request = json.loads(body)
+                    x, sr = load_audio(request['path'])
+                    emotion, name = request.get('emotion', 0), request['path']
+                else:
+                    x, sr = decode_audio(body)
+                    emotion = int(self.headers.get('X-Emotion', 0))
+                    name = self.headers.get('X-Utterance-Id', 'request')
+                seconds = len(x) / sr
+                payload = to_npz(service.extract(x, sr, emotion, name))
+            except Exception as e:
+                service.metrics.record_request(time.perf_counter() - t0, error=True)
+                self._send(400, json.dumps({'error': repr(e)}).encode('utf-8'))
+                return
+            service.metrics.record_request(time.perf_counter() - t0, seconds)
+            self._send(200, payload, 'application/octet-stream')
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def serve(service, host='127.0.0.1', port=8765):
+    server = ThreadingHTTPServer((host, port), make_handler(service))
+    server.daemon_threads = True
+    return server
+
+
+def request_features(url, path=None, audio_bytes=None, emotion=0):
+    '''
+    Localhost client: features of a file path (read by the service) or of audio bytes.
+    Returns a dict of arrays.
+    '''
+    if path is not None:
+        data = json.dumps({'path': path, 'emotion': emotion}).encode('utf-8')
+        headers = {'Content-Type': 'application/json'}
+    else:
+        data = audio_bytes
+        headers = {'Content-Type': 'application/octet-stream', 'X-Emotion': str(emotion)}
+    request = urllib.request.Request(url.rstrip('/') + '/extract', data=data, headers=headers)
+    with urllib.request.urlopen(request) as response:
+        with np.load(io.BytesIO(response.read())) as npz:
+            return {key: npz[key] for key in npz.files}
+
+
+def parse_arguments(argv):
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--features', type=str, default='logspec',
+        help='logspec, logmelspec or logdeltaspec')
+    parser.add_argument('--window', type=str, default='hamming')
+    parser.add_argument('--win_length', type=float, default=40)
+    parser.add_argument('--hop_length', type=float, default=10)
+    parser.add_argument('--ndft', type=int, default=800)
+    parser.add_argument('--nfreq', type=int, default=200)
+    parser.add_argument('--nmel', type=int, default=128)
+    parser.add_argument('--segment_size', type=int, default=300)
+    parser.add_argument('--sr', type=int, nargs='+', default=[16000],
+        help='Sampling rates to build the filterbanks for at startup.')
+    parser.add_argument('--backend', type=str, default='librosa',
+        help='librosa or torch (batched)')
+    parser.add_argument('--torch_threads', type=int, default=0)
+    parser.add_argument('--batch_size', type=int, default=8,
+        help='Largest micro-batch.')
+    parser.add_argument('--max_wait_ms', type=float, default=5.0,
+        help='Longest wait for more requests after the first one of a batch.')
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    args = parse_arguments(sys.argv[1:])
+    params = {'window': args.window, 'win_length': args.win_length, 'hop_length': args.hop_length,
+              'ndft': args.ndft, 'nfreq': args.nfreq, 'nmel': args.nmel,
+              'segment_size': args.segment_size, 'mixnoise': False,
+              'backend': args.backend, 'torch_threads': args.torch_threads}
+    service = FeatureService(args.features, params, srs=args.sr,
+                             batch_size=args.batch_size, max_wait_ms=args.max_wait_ms)
+    server = serve(service, args.host, args.port)
+    print(f'Serving {args.features} features on http://{args.host}:{args.port}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
@@ -0,0 +1,225 @@
+'''
+Author: Shihe Dong
+Description: Per-speaker .npy storage of the extracted features.
+Layout:
+    <features_dir>/manifest.json
+    <features_dir>/<speaker_id>/<field>.npy
+    <features_dir>/<speaker_id>/<field>@snr<snr>.npy   (--snr_list, one file per SNR)
+
+Float fields can be stored with a smaller encoding (see encode_field):
+    float16 : half precision, relative error <= 2**-11
+    q16/q8  : linear quantization x = offset + scale * q, q in uint16/uint8,
+              absolute error <= scale / 2 with scale = (max - min) / (2**bits - 1)
+The encoding, scale, offset and measured max error are stored in the manifest,
+and readers dequantize with decode_field.
+'''
+import os
+import json
+import numpy as np
+
+
+MANIFEST_NAME = 'manifest.json'
+ENCODINGS = ('float32', 'float16', 'q16', 'q8')
+QUANT_DTYPES = {'q16': np.uint16, 'q8': np.uint8}
+
+
+def _blocks(n, block):
+    return [(i, min(i + block, n)) for i in range(0, max(n, 1), block)]
+
+
+def encode_field(value, encoding, max_error=None, block=1024, grid=None):
+    '''
+    Encode a float array. Returns the stored array and its manifest entry
+    {'encoding', 'scale', 'offset', 'max_error'}.
+
+    The dequantization error is measured on the whole array and checked against
+    its bound (scale / 2 for q16/q8, half an ulp for float16); if <max_error>
+    is given, a larger error raises a ValueError.
+    Works in blocks of rows, so memmap inputs are not loaded at once.
+    grid: optional (offset, scale) of an existing q16/q8 grid to quantize onto,
+          eg. the grid of rows copied unchanged by feature_update.py. The values
+          must lie within it.
+    '''
+    if encoding not in ENCODINGS:
+        raise ValueError(f'Unknown encoding <{encoding}>, options: {ENCODINGS}')
+    if encoding == 'float32':
+        return value, {'encoding': 'float32', 'max_error': 0.0}
+    n = len(value)
+    if encoding == 'float16':
+        info = {'encoding': 'float16'}
+        encoded = np.empty(value.shape, dtype=np.float16)
+        for i, j in _blocks(n, block):
+            encoded[i:j] = value[i:j]
+        if not np.isfinite(encoded).all():
+            raise ValueError('float16 overflow, use q16 or q8 instead')
+        magnitude = max((float(np.abs(value[i:j]).max()) for i, j in _blocks(n, block) if j > i), default=0.0)
+        # Half an ulp, and half the smallest subnormal near 0
+        bound = np.finfo(np.float16).eps / 2 * magnitude + 2.0 ** -25
+    else:
+        levels = np.iinfo(QUANT_DTYPES[encoding]).max
+        if grid is not None:
+            lo, scale = grid
+            hi = lo + scale * levels
+        else:
+            lo = min((float(value[i:j].min()) for i, j in _blocks(n, block) if j > i), default=0.0)
+            hi = max((float(value[i:j].max()) for i, j in _blocks(n, block) if j > i), default=0.0)
+            scale = (hi - lo) / levels if hi > lo else 1.0
+        info = {'encoding': encoding, 'scale': scale, 'offset': lo}
+        encoded = np.empty(value.shape, dtype=QUANT_DTYPES[encoding])
+        for i, j in _blocks(n, block):
+            encoded[i:j] = np.clip(np.rint((value[i:j] - lo) / scale), 0, levels)
+        magnitude = max(abs(lo), abs(hi))
+        bound = scale / 2
+
+    # Measured max error, against the documented bound (plus float32 rounding)
+    error = max((float(np.abs(decode_field(encoded[i:j], info) - value[i:j]).max())
+                 for i, j in _blocks(n, block) if j > i), default=0.0)
+    tolerance = bound + 4 * np.finfo(np.float32).eps * magnitude
+    assert error <= tolerance, f'{encoding} error {error} above its bound {bound}'
+    if max_error is not None and error > max_error:
+        raise ValueError(f'{encoding} max error {error:.3g} above the allowed {max_error:.3g}')
+    info['max_error'] = error
+    return encoded, info
+
+
+def decode_field(value, info):
+    '''
+    Dequantize a stored array (or rows of it) to float32, given its manifest entry.
+    '''
+    encoding = info.get('encoding', 'float32') if info is not None else 'float32'
+    if encoding in QUANT_DTYPES:
+        return (np.asarray(value, dtype=np.float32) * np.float32(info['scale'])
+                + np.float32(info['offset']))
+    if encoding == 'float16':
+        return np.asarray(value, dtype=np.float32)
+    return value
+
+
+def file_signatures(file_list):
+    '''
+    [wav_path, label, size, mtime_ns] of every (wav_path, label) of a speaker,
+    stored in the manifest to detect new, modified and removed files.
+    '''
+    signatures = []
+    for wav_path, label in file_list:
+        st = os.stat(wav_path)
+        signatures.append([wav_path, int(label), st.st_size, st.st_mtime_ns])
+    return signatures
+
+
+def snr_field(field, snr):
+    '''
+    Name of the stored SNR version of a field, eg. seg_spec@snr10.
+    '''
+    return f'{field}@snr{snr:g}'
+
+
+def _save_field(speaker_dir, name, value, encoding=None, max_error=None):
+    value = np.asarray(value)
+    info = {}
+    if encoding is not None and value.dtype.kind == 'f':
+        value, info = encode_field(value, encoding, max_error)
+    np.save(os.path.join(speaker_dir, name + '.npy'), value)
+    return {'shape': list(value.shape), 'dtype': str(value.dtype), **info}
+
+
+def save_speaker(features_dir, speaker_id, speaker_data, encodings=None, max_error=None, files=None,
+                 encoded=None):
+    '''
+    Write the shard of one speaker and return its manifest entry.
+    files: optional file_signatures of the speaker's utterances.
+    encoded: optional {field: manifest entry} of fields of <speaker_data> that
+             are already encoded; they are written as they are.
+
+    With --snr_list, the per-SNR lists of arrays are written as one file per SNR
+    (see snr_field), so every stored field keeps one row per segment; the entry
+    lists the SNRs under 'snr_list'.
+    '''
+    encodings = encodings if encodings is not None else {}
+    max_error = max_error if max_error is not None else {}
+    speaker_dir = os.path.join(features_dir, str(speaker_id))
+    os.makedirs(speaker_dir, exist_ok=True)
+    encoded = encoded if encoded is not None else {}
+    snr_list = speaker_data.get('snr_list')
+    fields = {}
+    for field, value in speaker_data.items():
+        if field in encoded:
+            fields[field] = {**_save_field(speaker_dir, field, value), **encoded[field]}
+            continue
+        if snr_list is not None and field != 'snr_list' and isinstance(value, (list, tuple)):
+            for snr, variant in zip(snr_list, value):
+                fields[snr_field(field, snr)] = {**_save_field(speaker_dir, snr_field(field, snr), variant,
+                                                               encodings.get(field), max_error.get(field)),
+                                                 'variant_of': field, 'snr': float(snr)}
+            continue
+        fields[field] = _save_field(speaker_dir, field, value, encodings.get(field), max_error.get(field))
+    entry = {'num_segments': int(len(speaker_data['seg_label'])), 'fields': fields}
+    if snr_list is not None:
+        entry['snr_list'] = [float(snr) for snr in snr_list]
+    if files is not None:
+        entry['files'] = files
+    return entry
+
+
+def save_feature_dir(features_data, features_dir, meta=None, encodings=None, max_error=None,
+                     speaker_files=None):
+    '''
+    Save the output of extract_features as one .npy file per speaker and field,
+    plus a manifest.json describing speakers, fields and shapes.
+
+    encodings: optional {field: encoding}, eg. {'seg_spec': 'q8', 'seg_audio': 'float16'}.
+    max_error: optional {field: largest allowed dequantization error}.
+    speaker_files: optional get_files() output; the size and mtime of every file
+                   are recorded so that the directory can be updated incrementally.
+    '''
+    os.makedirs(features_dir, exist_ok=True)
+    manifest = {'meta': meta if meta is not None else {}, 'speakers': {}}
+    for speaker_id, speaker_data in features_data.items():
+        files = file_signatures(speaker_files[speaker_id]) if speaker_files is not None else None
+        manifest['speakers'][str(speaker_id)] = save_speaker(features_dir, speaker_id, speaker_data,
+                                                             encodings, max_error, files)
+    save_manifest(manifest, features_dir)
+    return manifest
+
+
+def save_manifest(manifest, features_dir):
+    with open(os.path.join(features_dir, MANIFEST_NAME), 'w', encoding='utf-8') as fout:
+        json.dump(manifest, fout, indent=2)
+
+
+def load_manifest(features_dir):
+    with open(os.path.join(features_dir, MANIFEST_NAME), 'r', encoding='utf-8') as fin:
+        return json.load(fin)
+
+
+def load_field(features_dir, speaker_id, field, mmap=True):
+    '''
+    Open one field of one speaker. With mmap=True nothing is read until accessed.
+    '''
+    path = os.path.join(features_dir, str(speaker_id), field + '.npy')
+    return np.load(path, mmap_mode='r' if mmap else None)
+
+
+def field_info(manifest, speaker_id, field):
+    return manifest['speakers'][str(speaker_id)]['fields'].get(field)
+
+
+def load_feature_dir(features_dir, speakers=None, mmap=True, decode=True):
+    '''
+    Load a feature directory back into the extract_features dict layout.
+    The arrays are read-only memmaps unless mmap=False. Encoded fields are
+    dequantized in memory unless decode=False.
+    '''
+    manifest = load_manifest(features_dir)
+    if speakers is None:
+        speakers = list(manifest['speakers'].keys())
+    features_data = {}
+    for speaker_id in speakers:
+        fields = manifest['speakers'][speaker_id]['fields']
+        features_data[speaker_id] = {field: load_field(features_dir, speaker_id, field, mmap)
+                                     for field in fields}
+        if decode:
+            for field, info in fields.items():
+                if info.get('encoding', 'float32') != 'float32':
+                    features_data[speaker_id][field] = decode_field(features_data[speaker_id][field], info)
+    return features_data
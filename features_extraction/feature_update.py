@@ -0,0 +1,231 @@
+'''
+Author: Shihe Dong
+Description: Incremental update of a feature directory (see feature_store.py).
+The current get_files() is compared with the file signatures of the previous
+manifest: only new or modified files are extracted, removed files are dropped,
+and only the shards of the affected speakers are rewritten.
+'''
+import os
+import shutil
+import numpy as np
+
+from feature_store import (load_field, decode_field, encode_field, file_signatures, save_speaker,
+                           save_manifest, QUANT_DTYPES)
+from features_util import segment_stats
+from norm_stats import summarize_stats
+
+
+# Parameters that change the extracted values, they must match the previous run
+VALUE_PARAMS = ('window', 'win_length', 'hop_length', 'ndft', 'nfreq', 'nmel', 'segment_size',
+                'mixnoise', 'snr_list', 'seed')
+
+# Fields with one row per utterance, the others have one row per segment
+UTTERANCE_FIELDS = ('utter_label', 'seg_num', 'utter_text')
+
+
+def check_compatible(manifest, features, params):
+    '''
+    Raise a ValueError if the previous run cannot be updated with <features>/<params>.
+    '''
+    meta = manifest['meta']
+    if meta.get('features') != features:
+        raise ValueError(f'--update with {features} features, the previous run extracted {meta.get("features")}')
+    for key in VALUE_PARAMS:
+        if meta.get('params', {}).get(key) != params.get(key):
+            raise ValueError(f'--update with {key}={params.get(key)}, '
+                             f'the previous run used {meta.get("params", {}).get(key)}')
+    if params.get('snr_list'):
+        raise ValueError('--update does not support --snr_list outputs')
+    missing = [s for s, entry in manifest['speakers'].items() if 'files' not in entry]
+    if missing:
+        raise ValueError(f'No file signatures in the previous manifest for {missing}, '
+                         f'run a full extraction first')
+
+
+def diff_files(manifest, speaker_files):
+    '''
+    Compare get_files() with the file signatures of a previous manifest.
+
+    Returns a dict with:
+        extract:          {speaker: [(wav_path, label), ...]} new or modified files
+        reuse:            {speaker: [previous utterance index, or None if extracted,
+                           for every current file]}, for the affected speakers only
+        removed_speakers: speakers of the previous run without any file left
+        new, modified, removed, unchanged: numbers of files
+    A file is modified if its size, mtime or label changed.
+    '''
+    diff = {'extract': {}, 'reuse': {}, 'removed_speakers': [],
+            'new': 0, 'modified': 0, 'removed': 0, 'unchanged': 0}
+    for speaker_id, file_list in speaker_files.items():
+        old_files = manifest['speakers'].get(str(speaker_id), {}).get('files', [])
+        old_index = {f[0]: i for i, f in enumerate(old_files)}
+        reuse, extract = [], []
+        for signature, item in zip(file_signatures(file_list), file_list):
+            i = old_index.pop(signature[0], None)
+            if i is not None and old_files[i] == signature:
+                reuse.append(i)
+                diff['unchanged'] += 1
+            else:
+                reuse.append(None)
+                extract.append(item)
+                diff['new' if i is None else 'modified'] += 1
+        diff['removed'] += len(old_index)
+        # Same files in the same order: the shard is kept as is
+        if reuse != list(range(len(old_files))):
+            diff['reuse'][speaker_id] = reuse
+            if extract:
+                diff['extract'][speaker_id] = extract
+
+    current = {str(speaker_id) for speaker_id in speaker_files}
+    for speaker_id, entry in manifest['speakers'].items():
+        if speaker_id not in current:
+            diff['removed_speakers'].append(speaker_id)
+            diff['removed'] += len(entry['files'])
+    return diff
+
+
+def _rows(speaker_data, field, offsets, u):
+    if field in UTTERANCE_FIELDS:
+        return speaker_data[field][u:u + 1]
+    return speaker_data[field][offsets[u]:offsets[u + 1]]
+
+
+def merge_speaker(old_data, new_data, reuse):
+    '''
+    Rows of one speaker in the current file order, taken from the previous shard
+    (old_data) or from the newly extracted files (new_data, in order of extraction).
+    '''
+    fields = list((new_data if new_data is not None else old_data).keys())
+    if old_data is not None and new_data is not None and set(old_data) != set(new_data):
+        raise ValueError(f'Fields {sorted(new_data)} differ from the previous run {sorted(old_data)}')
+    offsets = {}
+    for name, data in (('old', old_data), ('new', new_data)):
+        if data is not None:
+            offsets[name] = np.concatenate([[0], np.cumsum(np.asarray(data['seg_num'], dtype=np.int64))])
+
+    pieces = {field: [] for field in fields}
+    j = 0
+    for i in reuse:
+        if i is None:
+            data, offs, u = new_data, offsets['new'], j
+            j += 1
+        else:
+            data, offs, u = old_data, offsets['old'], i
+        for field in fields:
+            pieces[field].append(_rows(data, field, offs, u))
+    return {field: np.concatenate(rows) for field, rows in pieces.items()}
+
+
+def previous_encodings(manifest):
+    '''
+    Encodings of the previous run: from its meta, else from the fields of any of its speakers.
+    '''
+    if manifest['meta'].get('encodings'):
+        return dict(manifest['meta']['encodings'])
+    encodings = {}
+    for entry in manifest['speakers'].values():
+        for field, info in entry['fields'].items():
+            if info.get('encoding', 'float32') != 'float32':
+                encodings.setdefault(field, info['encoding'])
+    return encodings
+
+
+def copy_quantized(field, info, old_raw, old_seg_num, new_data, reuse, max_error=None):
+    '''
+    Rows of a q16/q8 field on the grid of the previous shard: the copied rows
+    are kept as stored and only the new rows are quantized, so updates do not
+    accumulate error. Returns (rows, manifest entry), or None if the new rows
+    fall outside the previous grid.
+    '''
+    levels = np.iinfo(QUANT_DTYPES[info['encoding']]).max
+    lo, hi = info['offset'], info['offset'] + info['scale'] * levels
+    new_rows, error = None, 0.0
+    if new_data is not None:
+        values = np.asarray(new_data[field])
+        if len(values) and (values.min() < lo or values.max() > hi):
+            return None
+        new_rows, new_info = encode_field(values, info['encoding'], max_error, grid=(info['offset'], info['scale']))
+        new_rows = {'seg_num': new_data['seg_num'], field: new_rows}
+        error = new_info['max_error']
+    rows = merge_speaker({'seg_num': old_seg_num, field: old_raw}, new_rows, reuse)[field]
+    return rows, {'encoding': info['encoding'], 'scale': info['scale'], 'offset': info['offset'],
+                  'max_error': max(info.get('max_error', 0.0), error)}
+
+
+def update_feature_dir(features_dir, manifest, diff, features_data, speaker_files, durations,
+                       features, params, encodings=None, max_error=None):
+    '''
+    Rewrite the shards of the speakers in diff['reuse'], delete the removed
+    speakers and save the updated manifest (including the normalization statistics).
+
+    features_data: extract_features output over diff['extract'].
+    encodings: {field: encoding}; by default the encodings of the previous run,
+               also for the speakers that are new in this update.
+
+    q16/q8 rows copied from the previous shards keep their stored values when the
+    new rows fit the previous grid. Otherwise the copied rows are quantized again,
+    and their recorded max_error is the sum of the previous and the new error.
+    '''
+    encodings = encodings if encodings else previous_encodings(manifest)
+    max_error = max_error if max_error is not None else {}
+    manifest['meta']['encodings'] = encodings
+    speaker_stats = {}
+    for speaker_id, reuse in diff['reuse'].items():
+        key = str(speaker_id)
+        if not reuse:
+            diff['removed_speakers'].append(key)
+            continue
+        old_entry = manifest['speakers'].get(key)
+        new_data = features_data.get(speaker_id)
+        old_raw, old_data = None, None
+        if old_entry is not None:
+            # Read into memory: the same files are overwritten below
+            old_raw = {field: load_field(features_dir, key, field, mmap=False) for field in old_entry['fields']}
+            old_data = {field: decode_field(old_raw[field], info) for field, info in old_entry['fields'].items()}
+        data = merge_speaker(old_data, new_data, reuse)
+
+        # Quantized fields whose previous grid still fits: stored rows copied unchanged
+        encoded = {}
+        if old_entry is not None:
+            for field, info in old_entry['fields'].items():
+                if info.get('encoding') in QUANT_DTYPES and encodings.get(field) == info['encoding']:
+                    copied = copy_quantized(field, info, old_raw[field], old_raw['seg_num'], new_data, reuse,
+                                            max_error.get(field))
+                    if copied is not None:
+                        data[field], encoded[field] = copied
+
+        entry = save_speaker(features_dir, key, data, encodings, max_error,
+                             files=file_signatures(speaker_files[speaker_id]), encoded=encoded)
+        if old_entry is not None and any(i is not None for i in reuse):
+            for field, info in entry['fields'].items():
+                old_info = old_entry['fields'].get(field, {})
+                old_error = old_info.get('max_error', 0.0)
+                if field in encoded or not old_error:
+                    continue
+                if old_info.get('encoding') == info.get('encoding') == 'float16':
+                    # float16 values are encoded again exactly
+                    info['max_error'] = max(info['max_error'], old_error)
+                else:
+                    # The copied rows were already lossy: the errors add up
+                    info['max_error'] = info.get('max_error', 0.0) + old_error
+                if field in max_error and info['max_error'] > max_error[field]:
+                    raise ValueError(f'{field}: max error {info["max_error"]:.3g} after re-encoding the'
+                                     f' previous rows, above the allowed {max_error[field]:.3g}')
+        manifest['speakers'][key] = entry
+        stats_data = {field: decode_field(data[field], encoded.get(field)) for field in ('seg_spec', 'seg_mfcc')}
+        speaker_stats[key] = segment_stats(speaker_files[speaker_id], stats_data['seg_spec'], stats_data['seg_mfcc'],
+                                           data['seg_num'], durations, features, params)
+
+    for key in diff['removed_speakers']:
+        manifest['speakers'].pop(key, None)
+        shutil.rmtree(os.path.join(features_dir, key), ignore_errors=True)
+
+    # Keep the order of get_files()
+    manifest['speakers'] = {str(s): manifest['speakers'][str(s)] for s in speaker_files
+                            if str(s) in manifest['speakers']}
+    previous = manifest.get('stats')
+    if previous is not None:
+        previous = {'speakers': {s: v for s, v in previous['speakers'].items() if s in manifest['speakers']}}
+    manifest['stats'] = summarize_stats(speaker_stats, previous)
+    save_manifest(manifest, features_dir)
+    return manifest
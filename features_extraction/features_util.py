@@ -10,73 +10,552 @@ import librosa.display
 import matplotlib.pyplot as plt
 import math
 import os
-from collections import defaultdict
+import hashlib
+import scipy.fft
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 from tqdm import tqdm
-from pysndfx import  AudioEffectsChain
+from effects import AudioEffectsChain
 import random
+from database import get_durations
+from norm_stats import RunningStats, update_segment_stats
 from transformers import BertTokenizer, BertModel, Wav2Vec2ForCTC, Wav2Vec2CTCTokenizer, Wav2Vec2Processor, AutoTokenizer
 
+# Local wav2vec2 checkpoint, used to normalize seg_audio
+WAV2VEC2_PATH = "G:\dsh_postgraduate\Other_Speech_model\wav2vec2-base-960h"
+
+
+class FeatureBank():
+    '''
+    Registry of the analysis windows, mel filterbanks and DCT bases.
+
+    They depend only on (sr, n_fft, n_mels, window), so each one is built once and
+    shared by every utterance. state()/update() hand the built entries over to
+    worker processes, so the workers do not rebuild them either. The wav2vec2
+    processor is loaded once per process.
+    '''
+    def __init__(self):
+        self.entries = {}
+        self._processor = None
+
+    def _get(self, key, build):
+        if key not in self.entries:
+            self.entries[key] = build()
+        return self.entries[key]
+
+    def window(self, window, win_length):
+        return self._get(('window', window, win_length),
+                         lambda: librosa.filters.get_window(window, win_length, fftbins=True))
+
+    def mel(self, sr, n_fft, n_mels=128, htk=False):
+        return self._get(('mel', sr, n_fft, n_mels, htk),
+                         lambda: librosa.filters.mel(sr=sr, n_fft=n_fft, n_mels=n_mels, htk=htk))
+
+    def dct(self, n_mels, n_mfcc):
+        # Orthonormal DCT-II as a (n_mfcc, n_mels) matrix, as scipy.fft.dct(norm='ortho')
+        return self._get(('dct', n_mels, n_mfcc),
+                         lambda: scipy.fft.dct(np.eye(n_mels, dtype=np.float32), type=2,
+                                               norm='ortho', axis=0)[:n_mfcc])
+
+    def processor(self):
+        if self._processor is None:
+            self._processor = Wav2Vec2Processor.from_pretrained(WAV2VEC2_PATH)
+        return self._processor
+
+    def build(self, srs, features, params):
+        '''
+        Build every entry needed to extract <features> at the sampling rates <srs>.
+        '''
+        for sr in srs:
+            win_length = int((params['win_length']/1000) * sr)
+            self.window(params['window'], win_length)
+            if features == 'logmelspec':
+                self.mel(sr, params['ndft'], params['nmel'])
+            self.window('hann', 2048)
+            self.mel(sr, 2048, 128, htk=True)
+        self.dct(128, 40)
+
+    def state(self):
+        return dict(self.entries)
+
+    def update(self, state):
+        self.entries.update(state)
+
+
+FEATURE_BANK = FeatureBank()
+
              
-def extract_features(speaker_files, features, params):
-    
-    processor = Wav2Vec2Processor.from_pretrained("G:\dsh_postgraduate\Other_Speech_model\wav2vec2-base-960h")
+def load_audio(wav_path):
+    '''
+    Decode one audio file at its native sampling rate.
+    '''
+    x, sr = librosa.load(wav_path, sr=None)
+    return x, sr
+
+
+class AudioCache():
+    '''
+    Decoded audio kept on disk as <cache_dir>/<key>.npz, shared by the worker
+    processes and by successive jobs on the same corpus (see run_jobs.py).
+    The key covers the path, size and mtime of the file, so modified files are
+    decoded again. Used as the loader of prefetch_audio.
+    '''
+    def __init__(self, cache_dir, loader=load_audio):
+        self.cache_dir = cache_dir
+        self.loader = loader
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def __call__(self, wav_path):
+        st = os.stat(wav_path)
+        key = hashlib.sha1(f'{os.path.abspath(wav_path)}|{st.st_size}|{st.st_mtime_ns}'.encode('utf-8')).hexdigest()
+        path = os.path.join(self.cache_dir, key + '.npz')
+        if os.path.isfile(path):
+            with np.load(path) as fin:
+                return fin['x'], int(fin['sr'])
+        x, sr = self.loader(wav_path)
+        # Write then rename, other processes may read the same entry
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as fout:
+            np.savez(fout, x=x, sr=sr)
+        os.replace(tmp_path, path)
+        return x, sr
+
+
+def prefetch_audio(wav_paths, depth=4, loader=load_audio):
+    '''
+    Decode audio files in background threads, <depth> files ahead of the consumer.
+
+    The files are yielded in the same order as <wav_paths>, as tuples of
+    (wav_path, x, sr). At most <depth> decoded files are held in the queue at any
+    time, so memory stays bounded while disk/network latency of the next files
+    overlaps with the feature computation of the current one.
+    depth <= 0 disables prefetching and decodes synchronously.
+    '''
+    wav_paths = list(wav_paths)
+    if depth <= 0:
+        for wav_path in wav_paths:
+            x, sr = loader(wav_path)
+            yield wav_path, x, sr
+        return
+
+    with ThreadPoolExecutor(max_workers=depth) as pool:
+        pending = deque()
+        next_idx = 0
+        # Fill the queue
+        while next_idx < len(wav_paths) and len(pending) < depth:
+            pending.append((wav_paths[next_idx], pool.submit(loader, wav_paths[next_idx])))
+            next_idx += 1
+        while pending:
+            wav_path, future = pending.popleft()
+            # Keep the queue full while the current file is being consumed
+            if next_idx < len(wav_paths):
+                pending.append((wav_paths[next_idx], pool.submit(loader, wav_paths[next_idx])))
+                next_idx += 1
+            x, sr = future.result()
+            yield wav_path, x, sr
+
+
+def utterance_rng(wav_path, seed=111):
+    '''
+    Random generator of one utterance for augmentation.
+
+    It is derived from the root <seed> and the utterance identity
+    (<parent folder>/<file name>, eg. train_splits/dia0_utt0.wav) through a
+    SeedSequence, so a file gets the same noise whichever worker processes it,
+    in whatever order, and on resumed runs.
+    '''
+    identity = '/'.join(wav_path.replace('\\', '/').split('/')[-2:])
+    key = int.from_bytes(hashlib.sha256(identity.encode('utf-8')).digest()[:8], 'little')
+    return np.random.default_rng(np.random.SeedSequence(seed, spawn_key=(key,)))
+
+
+def extract_utterance(x, sr, emotion, features, params, out=None, rng=None):
+    '''
+    Extract and segment the features of one decoded utterance.
+    Returns the tuple of segment_nd_features. If <out> is given, the segments
+    are written into those preallocated slots (see segment_nd_features).
+
+    If params['snr_list'] is set, Gaussian noise is added at every SNR of the list
+    and a list of tuples is returned instead, one per SNR (and <out> is a list too).
+    The noise is drawn from <rng>, see utterance_rng.
+    '''
+    # Apply pre-emphasis filter
+    x = librosa.effects.preemphasis(x, zi = [0.0])
+
+    # Add Gaussian Noise: all the SNR versions from a single decode
+    snr_list = params.get('snr_list')
+    if snr_list:
+        noisy = add_gaussian_noise_multi(x, snr_list, rng=rng)
+        if out is None:
+            out = [None] * len(snr_list)
+        return [segment_signal(y, sr, emotion, features, params, out=o) for y, o in zip(noisy, out)]
+
+    return segment_signal(x, sr, emotion, features, params, out=out)
+
+
+def segment_signal(x, sr, emotion, features, params, out=None):
+    '''
+    Features and segments of one pre-emphasized signal, see extract_utterance.
+    '''
+    if params.get('stft_block'):
+        return extract_utterance_chunked(x, sr, emotion, features, params, out=out)
+
+    # Extract required features into (C,F,T)
+    features_data = GET_FEATURES[features](x, sr, params)
+
+    hop_length = 160 # hop_length smaller, seq_len larger
+    # f0 = librosa.feature.zero_crossing_rate(x, hop_length=hop_length).T # (seq_len, 1)
+    # cqt = librosa.feature.chroma_cqt(y=x, sr=sr, n_chroma=24, bins_per_octave=72, hop_length=hop_length).T # (seq_len, 12)
+    mfcc = extract_mfcc(x, sr, n_mfcc=40, hop_length=hop_length) # (seq_len, 40)
+
+    # wav2vec
+    # input_values = processor(x, sampling_rate=sr, return_tensors="pt").input_values
+
+    # Segment features into (N,C,F,T)
+    return segment_nd_features(x, mfcc, features_data, emotion, params['segment_size'], out=out)
+
+
+def extract_file_list(file_list, features, params, outs=None):
+    '''
+    Extract the features of a list of (wav_path, emotion) with audio prefetching.
+    This is the unit of work of both the serial and the worker-based paths.
+    <outs> optionally holds one tuple of output slots per file.
+    Returns the list of segment_nd_features tuples, in the order of <file_list>.
+    '''
+    emotions = [emotion for _, emotion in file_list]
+    if outs is None:
+        outs = [None] * len(file_list)
+    results = []
+    loader = AudioCache(params['audio_cache']) if params.get('audio_cache') else load_audio
+    audio_iter = prefetch_audio([wav_path for wav_path, _ in file_list],
+                                depth=params.get('prefetch', 4), loader=loader)
+    if params.get('backend', 'librosa') == 'torch':
+        from torch_backend import extract_batch
+        def run(batch):
+            xs, srs, batch_emotions, batch_outs, rngs = zip(*batch)
+            return extract_batch(xs, srs[0], batch_emotions, features, params, outs=batch_outs, rngs=rngs)
+
+        batch = []
+        for (wav_path, x, sr), emotion, out in zip(audio_iter, emotions, outs):
+            print("Loading:", wav_path)
+            # A batch holds utterances of the same sampling rate
+            if batch and (len(batch) == params.get('batch_size', 16) or batch[-1][1] != sr):
+                results.extend(run(batch))
+                batch = []
+            batch.append((x, sr, emotion, out, utterance_rng(wav_path, params.get('seed', 111))))
+        if batch:
+            results.extend(run(batch))
+        return results
+
+    for (wav_path, x, sr), emotion, out in zip(audio_iter, emotions, outs):
+        # Read wave data
+        print("Loading:", wav_path)
+        results.append(extract_utterance(x, sr, emotion, features, params, out=out,
+                                         rng=utterance_rng(wav_path, params.get('seed', 111))))
+    return results
+
+
+def schedule_by_duration(items, durations, chunk_size=8, bucket_ratio=2.0):
+    '''
+    Group work items into chunks of similar length, longest chunks first.
+
+    Input:
+    ------
+        - items: list of (index, wav_path, emotion)
+        - durations: dict wav_path -> (num_samples, sr), see database.get_durations
+        - chunk_size: maximum number of files per chunk
+        - bucket_ratio: a chunk is closed when a file is <bucket_ratio> times
+                        shorter than the first (longest) file of the chunk
+
+    Return:
+    -------
+        - list of chunks, each a list of items
+    '''
+    def seconds(item):
+        num_samples, sr = durations[item[1]]
+        return num_samples / sr
+
+    chunks, chunk, chunk_len = [], [], 0.0
+    for item in sorted(items, key=seconds, reverse=True):
+        length = seconds(item)
+        if chunk and (len(chunk) >= chunk_size or length * bucket_ratio < chunk_len):
+            chunks.append(chunk)
+            chunk = []
+        if not chunk:
+            chunk_len = length
+        chunk.append(item)
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+def _init_worker(feature_bank_state):
+    '''
+    Worker initializer: receive the prebuilt windows and filterbanks.
+    '''
+    FEATURE_BANK.update(feature_bank_state)
+
+
+def _extract_chunk(chunk, features, params):
+    '''
+    Worker entry point: extract one chunk of (index, wav_path, emotion).
+    '''
+    results = extract_file_list([(wav_path, emotion) for _, wav_path, emotion in chunk],
+                                features, params)
+    return [(item[0], result) for item, result in zip(chunk, results)]
+
+
+def extract_parallel(speaker_files, features, params, durations, pool=None, on_result=None):
+    '''
+    Extract all files over a process pool, scheduling long files first.
+    Returns dict speaker_id -> list of segment_nd_features tuples, in the
+    original file order of each speaker.
+    pool: optional executor shared by several extractions (see run_jobs.py);
+          its workers build the FEATURE_BANK entries they need on first use.
+    on_result: optional on_result(speaker_id, position, result), called as each
+               result arrives; its return value is kept instead of the result,
+               so the caller can copy the arrays out and let them be freed.
+    '''
+    if pool is None:
+        with ProcessPoolExecutor(max_workers=params['num_workers'], initializer=_init_worker,
+                                 initargs=(FEATURE_BANK.state(),)) as pool:
+            return extract_parallel(speaker_files, features, params, durations, pool, on_result)
+
+    items, owners, positions = [], [], []
+    for speaker_id in speaker_files:
+        for position, (wav_path, emotion) in enumerate(speaker_files[speaker_id]):
+            items.append((len(items), wav_path, emotion))
+            owners.append(speaker_id)
+            positions.append(position)
+
+    chunks = schedule_by_duration(items, durations, params.get('chunk_size', 8))
+    results = [None] * len(items)
+    # Only as_completed holds the futures, it drops each one once it is yielded
+    futures = as_completed([pool.submit(_extract_chunk, chunk, features, params) for chunk in chunks])
+    for future in tqdm(futures, total=len(chunks)):
+        for idx, result in future.result():
+            results[idx] = result if on_result is None else on_result(owners[idx], positions[idx], result)
+
+    speaker_results = {speaker_id: [] for speaker_id in speaker_files}
+    for speaker_id, result in zip(owners, results):
+        speaker_results[speaker_id].append(result)
+    return speaker_results
+
+
+def feature_dims(features, params):
+    '''
+    Number of channels and frequency bins (C, F) of a feature type.
+    '''
+    nfreq = min(params['nfreq'], params['ndft'] // 2 + 1)
+    dims = {'logspec': (1, nfreq),
+            'logmelspec': (1, params['nmel']),
+            'logdeltaspec': (3, nfreq)}
+    return dims[features]
+
+
+def count_segments(num_samples, sr, params):
+    '''
+    Number of segments of an utterance, computed from its length only.
+    Mirrors the centred librosa framing (1 + n // hop) used by segment_nd_features.
+    '''
+    return math.ceil(count_frames(num_samples, sr, params) / params['segment_size'])
+
+
+def count_frames(num_samples, sr, params):
+    '''
+    Number of spectrogram frames of an utterance (centred librosa framing).
+    '''
+    hop_length = int((params['hop_length']/1000) * sr)
+    return 1 + num_samples // hop_length
+
+
+def plan_segments(speaker_files, durations, params):
+    '''
+    First (header-only) pass: number of segments of every utterance.
+    Returns dict speaker_id -> list of segment counts, in file order.
+    '''
+    plan = {}
+    for speaker_id in speaker_files:
+        plan[speaker_id] = [count_segments(*durations[wav_path], params)
+                            for wav_path, _ in speaker_files[speaker_id]]
+    return plan
+
+
+def allocate_features(num_segs, features, params, memmap_prefix=None):
+    '''
+    Allocate the segment arrays of one speaker once, with their exact final shape.
+    If <memmap_prefix> is given, the arrays are .npy memmaps named
+    <memmap_prefix>_<field>.npy instead of in-memory arrays.
+    '''
+    nch, nfreq = feature_dims(features, params)
+    segment_size = params['segment_size']
+    shapes = {"seg_spec": (num_segs, nch, nfreq, segment_size),
+              "seg_mfcc": (num_segs, segment_size, 40),
+              "seg_audio": (num_segs, segment_size * 160)}
+    arrays = {}
+    for field, shape in shapes.items():
+        if memmap_prefix is None:
+            arrays[field] = np.empty(shape, dtype=np.float32)
+        else:
+            arrays[field] = np.lib.format.open_memmap(f'{memmap_prefix}_{field}.npy', mode='w+',
+                                                      dtype=np.float32, shape=shape)
+    return arrays
+
+
+def segment_stats(file_list, seg_spec, seg_mfcc, seg_num, durations, features, params):
+    '''
+    Normalization statistics {'seg_spec': RunningStats, 'seg_mfcc': RunningStats}
+    of the segments of one speaker, over the valid frames of each segment.
+    '''
+    nch, nfreq = feature_dims(features, params)
+    stats = {'seg_spec': RunningStats((nch, nfreq)), 'seg_mfcc': RunningStats((40,))}
+    offsets = np.concatenate([[0], np.cumsum(np.asarray(seg_num, dtype=np.int64))])
+    for (wav_path, _), start, end in zip(file_list, offsets[:-1], offsets[1:]):
+        num_samples, sr = durations[wav_path]
+        # seg_mfcc is sliced with the spectrogram frame range, so both have the same valid frames
+        valid = min(count_frames(num_samples, sr, params), params['segment_size'])
+        update_segment_stats(stats, seg_spec[start:end], seg_mfcc[start:end], valid)
+    return stats
+
+
+def extract_features(speaker_files, features, params, durations=None, stats=None, duplicates=None,
+                     pool=None):
+    '''
+    Extract the segmented features of every speaker.
+
+    stats: optional dict, filled with {speaker_id: {field: RunningStats}} of the
+           per-bin mean/std of seg_spec and seg_mfcc, accumulated while the
+           segments are written and excluding padded frames (see norm_stats.py).
+    duplicates: optional {wav_path: wav_path of its first occurrence}, see
+                database.find_duplicates. The features of a duplicate are copied
+                from its first occurrence instead of being extracted again (with
+                mixnoise, the copy has the noise of the first occurrence).
+    pool: optional process pool shared across calls, used if params['num_workers'] > 1.
+    '''
+    duplicates = duplicates if duplicates is not None else {}
+    # Files to extract, by index in the file list of each speaker
+    compute = {speaker_id: [i for i, (wav_path, _) in enumerate(speaker_files[speaker_id])
+                            if wav_path not in duplicates]
+               for speaker_id in speaker_files}
+    computed_slots = {}
+
     speaker_features = defaultdict()
-    # data_mfcc = list()
-    for speaker_id in tqdm(speaker_files.keys()):
+
+    # First pass: exact number of segments from the file headers
+    if durations is None:
+        durations = get_durations(speaker_files)
+    plan = plan_segments(speaker_files, durations, params)
+    FEATURE_BANK.build({sr for _, sr in durations.values()}, features, params)
+
+    memmap_dir = params.get('memmap_dir')
+
+    # One set of output arrays per SNR version
+    snr_list = params.get('snr_list')
+    variants = snr_list if snr_list else [None]
+
+    # Output arrays of every speaker, allocated once with their final shape
+    speaker_arrays, speaker_outs = {}, {}
+    for speaker_id in speaker_files:
+        offsets = np.concatenate([[0], np.cumsum(plan[speaker_id])])
+        arrays = []
+        for snr in variants:
+            memmap_prefix = None
+            if memmap_dir is not None:
+                memmap_prefix = os.path.join(memmap_dir, str(speaker_id))
+                if snr is not None:
+                    memmap_prefix += f'_snr{snr:g}'
+            arrays.append(allocate_features(int(offsets[-1]), features, params, memmap_prefix))
+        outs = [[tuple(variant[field][offsets[i]:offsets[i+1]]
+                       for field in ("seg_spec", "seg_mfcc", "seg_audio"))
+                 for variant in arrays]
+                for i in range(len(plan[speaker_id]))]
+        speaker_arrays[speaker_id] = arrays
+        speaker_outs[speaker_id] = outs if snr_list else [out[0] for out in outs]
+
+    num_workers = params.get('num_workers', 1)
+    if num_workers > 1:
+        def copy_result(speaker_id, position, result):
+            # Copy a worker result into its slots as it arrives and keep only the segment counts
+            out = speaker_outs[speaker_id][compute[speaker_id][position]]
+            for features_segmented, slot in zip(result if snr_list else [result],
+                                                out if snr_list else [out]):
+                slot[0][...] = features_segmented[1]
+                slot[1][...] = features_segmented[4]
+                slot[2][...] = features_segmented[5]
+            return [(r[0],) for r in result] if snr_list else (result[0],)
+
+        speaker_results = extract_parallel({speaker_id: [speaker_files[speaker_id][i] for i in idx]
+                                            for speaker_id, idx in compute.items()},
+                                           features, params, durations, pool=pool, on_result=copy_result)
+    else:
+        speaker_results = None
+
+    # Second pass: write the segments directly into their final slots
+    for speaker_id in tqdm(speaker_files.keys(), disable=speaker_results is not None):
         
-        data_tot, labels_tot, labels_segs_tot, segs, data_mfcc, data_audio = list(), list(), list(), list(), list(), list()
-        for wav_path, emotion in speaker_files[speaker_id]:
-            
-            # Read wave data
-            print("Loading:", wav_path)
+        segs = np.asarray(plan[speaker_id], dtype=np.int32)
+        arrays = speaker_arrays.pop(speaker_id)
+        outs = speaker_outs.pop(speaker_id)
 
-            x, sr = librosa.load(wav_path, sr=None)
-
-            # Apply pre-emphasis filter
-            x = librosa.effects.preemphasis(x, zi = [0.0])
-
-            # #Add Gaussian Noise
-            # x = add_gaussian_noise(x,30)
-
-            # Extract required features into (C,F,T)
-            features_data = GET_FEATURES[features](x, sr, params)
-            
-            hop_length = 160 # hop_length smaller, seq_len larger
-            # f0 = librosa.feature.zero_crossing_rate(x, hop_length=hop_length).T # (seq_len, 1)
-            # cqt = librosa.feature.chroma_cqt(y=x, sr=sr, n_chroma=24, bins_per_octave=72, hop_length=hop_length).T # (seq_len, 12)
-            mfcc = librosa.feature.mfcc(y=x, sr=sr, n_mfcc=40, hop_length=hop_length, htk=True).T # (seq_len, 20)
-            
-            # wav2vec
-            # input_values = processor(x, sampling_rate=sr, return_tensors="pt").input_values
-            
-            # Segment features into (N,C,F,T)
-            features_segmented = segment_nd_features(x, mfcc, features_data, emotion, params['segment_size'])
-
-            #Collect all the segments
-            data_tot.append(features_segmented[1])
-            labels_tot.append(features_segmented[3])
-            labels_segs_tot.extend(features_segmented[2])
-            segs.append(features_segmented[0])
-            data_mfcc.append(features_segmented[4])
-            data_audio.append(features_segmented[5])
-
-        # Post process
-        data_tot = np.vstack(data_tot).astype(np.float32)
-        data_mfcc = np.vstack(data_mfcc).astype(np.float32)
-        data_audio = np.vstack(data_audio).astype(np.float32)
-        labels_tot = np.asarray(labels_tot, dtype=np.int8)
-        labels_segs_tot = np.asarray(labels_segs_tot, dtype=np.int8)
-        segs = np.asarray(segs, dtype=np.int8)
+        idx = compute[speaker_id]
+        if speaker_results is not None:
+            results = speaker_results.pop(speaker_id)
+        else:
+            results = extract_file_list([speaker_files[speaker_id][i] for i in idx], features, params,
+                                        outs=[outs[i] for i in idx])
+
+        # Duplicates: copy the slots of the first occurrence
+        utterances = [None] * len(segs)
+        for i, result in zip(idx, results):
+            utterances[i] = result
+            # Only the slots and segment counts, not the (possibly copied) arrays of the result
+            computed_slots[speaker_files[speaker_id][i][0]] = (outs[i], [(r[0],) for r in result]
+                                                               if snr_list else (result[0],))
+        for i, (wav_path, _) in enumerate(speaker_files[speaker_id]):
+            if utterances[i] is None:
+                source_out, utterances[i] = computed_slots[duplicates[wav_path]]
+                for source, slot in zip(source_out if snr_list else [source_out],
+                                        outs[i] if snr_list else [outs[i]]):
+                    for k in range(3):
+                        slot[k][...] = source[k]
+
+        # Make sure the header pass predicted every utterance correctly
+        for (wav_path, _), result, num_segs in zip(speaker_files[speaker_id], utterances, segs):
+            features_segmented = result[0] if snr_list else result
+            assert features_segmented[0] == num_segs, \
+                f"{wav_path}: {features_segmented[0]} segments extracted, {num_segs} expected from header"
+
+        # Normalization statistics of the valid frames
+        if stats is not None:
+            stats[speaker_id] = {}
+            for snr, variant in zip(variants, arrays):
+                suffix = '' if snr is None else f'@snr{snr:g}'
+                variant_stats = segment_stats(speaker_files[speaker_id], variant["seg_spec"], variant["seg_mfcc"],
+                                              segs, durations, features, params)
+                for field, field_stats in variant_stats.items():
+                    stats[speaker_id][field + suffix] = field_stats
+
+        if snr_list:
+            # SNR versions side by side, in the order of params['snr_list']
+            data_tot = [variant["seg_spec"] for variant in arrays]
+            data_mfcc = [variant["seg_mfcc"] for variant in arrays]
+            data_audio = [variant["seg_audio"] for variant in arrays]
+        else:
+            data_tot = arrays[0]["seg_spec"]
+            data_mfcc = arrays[0]["seg_mfcc"]
+            data_audio = arrays[0]["seg_audio"]
+        labels_tot = np.asarray([emotion for _, emotion in speaker_files[speaker_id]], dtype=np.int8)
+        labels_segs_tot = np.repeat(labels_tot, segs)
         
         # Make sure everything is extracted properly
         assert len(labels_tot) == len(segs)#+ == data_mfcc.shape[0]
-        assert data_tot.shape[0] == labels_segs_tot.shape[0] == sum(segs)
+        assert arrays[0]["seg_spec"].shape[0] == labels_segs_tot.shape[0] == sum(segs)
 
 
         #Put into speaker features dictionary
-        print(data_tot.shape)
+        print(arrays[0]["seg_spec"].shape)
         print(labels_segs_tot.shape)
-        print(data_audio.shape)
+        print(arrays[0]["seg_audio"].shape)
         print(labels_tot.shape)
         print(segs.shape)
         print(labels_tot.shape)
@@ -87,6 +566,8 @@ def extract_features(speaker_files, features, params):
         audio_features["seg_num"] = segs
         audio_features["seg_mfcc"] = data_mfcc
         audio_features["seg_audio"] = data_audio
+        if snr_list:
+            audio_features["snr_list"] = list(snr_list)
         speaker_features[speaker_id] = audio_features #(data_tot, labels_tot, labels_segs_tot, segs)
 
     
@@ -144,7 +625,7 @@ def extract_logspec(x, sr, params):
     #calculate stft
     spec = np.abs(librosa.stft(x, n_fft=ndft,hop_length=hop_length,
                                         win_length=win_length,
-                                        window=window))
+                                        window=FEATURE_BANK.window(window, win_length)))
     
     spec =  librosa.amplitude_to_db(spec, ref=np.max)
     
@@ -170,10 +651,10 @@ def extract_logmelspec(x, sr, params):
     
 
     #calculate stft
-    melspec = librosa.feature.melspectrogram(y=x, sr=sr, n_mels=n_mels,
-                                        n_fft=ndft,hop_length=hop_length,
+    spec = np.abs(librosa.stft(x, n_fft=ndft,hop_length=hop_length,
                                         win_length=win_length,
-                                        window=window)
+                                        window=FEATURE_BANK.window(window, win_length))) ** 2.0
+    melspec = np.einsum("...ft,mf->...mt", spec, FEATURE_BANK.mel(sr, ndft, n_mels), optimize=True)
     
     logmelspec =  librosa.power_to_db(melspec, ref=np.max)
 
@@ -208,7 +689,19 @@ def extract_logdeltaspec(x, sr, params):
     return logspec
 
 
-def segment_nd_features(input_values, mfcc, data, emotion, segment_size):
+def extract_mfcc(x, sr, n_mfcc=40, hop_length=160):
+    '''
+    librosa.feature.mfcc(y=x, sr=sr, n_mfcc=n_mfcc, hop_length=hop_length, htk=True).T
+    with the window, mel filterbank and DCT basis taken from FEATURE_BANK.
+    Returns (T, n_mfcc).
+    '''
+    spec = np.abs(librosa.stft(x, n_fft=2048, hop_length=hop_length,
+                               window=FEATURE_BANK.window('hann', 2048))) ** 2.0
+    melspec = np.einsum("...ft,mf->...mt", spec, FEATURE_BANK.mel(sr, 2048, 128, htk=True), optimize=True)
+    return (FEATURE_BANK.dct(128, n_mfcc) @ librosa.power_to_db(melspec)).T
+
+
+def segment_nd_features(input_values, mfcc, data, emotion, segment_size, out=None):
     '''
     Segment features into <segment_size> frames.
     Pad with 0 if data frames < segment_size
@@ -218,6 +711,9 @@ def segment_nd_features(input_values, mfcc, data, emotion, segment_size):
         - data: shape is (Channels, Fime, Time)
         - emotion: emotion label for the current utterance data
         - segment_size: length of each segment
+        - out: optional tuple of preallocated (spec, mfcc, audio) arrays of shapes
+               (N, C, F, segment_size), (N, segment_size, n_mfcc), (N, segment_size*160).
+               The segments are written into them instead of new arrays.
     
     Return:
     -------
@@ -231,10 +727,8 @@ def segment_nd_features(input_values, mfcc, data, emotion, segment_size):
                     - len(segment labels) == number of segments
     '''
     segment_size_wav = segment_size * 160
-    # Transpose data to C, T, F
     
-    data = data.transpose(0,2,1)
-    time = data.shape[1]
+    time = data.shape[2]
     time_wav = input_values.shape[0]
     nch = data.shape[0]
     start, end = 0, segment_size
@@ -242,12 +736,18 @@ def segment_nd_features(input_values, mfcc, data, emotion, segment_size):
     num_segs = math.ceil(time / segment_size) # number of segments of each utterance
     #if num_segs > 1:
     #    num_segs = num_segs - 1
-    mfcc_tot = []
-    audio_tot = []
-    data_tot = []
-    sf = 0
+
+    if out is None:
+        data_tot = np.empty((num_segs, nch, data.shape[1], segment_size), dtype=np.float32)
+        mfcc_tot = np.empty((num_segs, segment_size, mfcc.shape[1]), dtype=np.float32)
+        audio_tot = np.empty((num_segs, segment_size_wav), dtype=np.float32)
+    else:
+        data_tot, mfcc_tot, audio_tot = out
+        assert data_tot.shape[0] == num_segs, \
+            f"{data_tot.shape[0]} output slots for {num_segs} segments"
     
-    processor = Wav2Vec2Processor.from_pretrained("G:\dsh_postgraduate\Other_Speech_model\wav2vec2-base-960h")
+    processor = FEATURE_BANK.processor()
+    audio_pad = np.zeros(segment_size_wav, dtype=input_values.dtype)
     
     for i in range(num_segs):
         # The last segment
@@ -263,38 +763,21 @@ def segment_nd_features(input_values, mfcc, data, emotion, segment_size):
             print('truncated')
             break
         """
-        # Do padding
-        mfcc_pad = np.pad(
-                mfcc[start:end], ((0, segment_size - (end - start)), (0, 0)), mode="constant")
+        # Do padding (spectrogram and mfcc at the back, audio at the front)
+        data_tot[i, :, :, :end - start] = data[:, :, start:end]
+        data_tot[i, :, :, end - start:] = 0
+        mfcc_tot[i, :end - start] = mfcc[start:end]
+        mfcc_tot[i, end - start:] = 0
         
-        audio_pad = np.pad(input_values[start_wav:end_wav], ((segment_size_wav - (end_wav - start_wav)), (0)), mode="constant")
-  
-        data_pad = []
-        for c in range(nch):
-            data_ch = data[c]
-            data_ch = np.pad(
-                data_ch[start:end], ((0, segment_size - (end - start)), (0, 0)), mode="constant")
-                #data_ch[start:end], ((0, segment_size - (end - start)), (0, 0)), mode="constant",
-                #constant_values=((-80,-80),(-80,-80)))
-            data_pad.append(data_ch)
-
+        audio_pad[:segment_size_wav - (end_wav - start_wav)] = 0
+        audio_pad[segment_size_wav - (end_wav - start_wav):] = input_values[start_wav:end_wav]
         
         #audio_wav = processor(audio_wav.cpu(), sampling_rate=16000, return_tensors="pt").input_values# [1, batch, 48000] 
         #audio_wav = audio_wav.permute(1, 2, 0) # [batch, 48000, 1] 
         #audio_wav = audio_wav.reshape(audio_wav.shape[0],-1) # [batch, 48000] 
-        
-        
-        data_pad = np.array(data_pad)
-        
-        # Stack
-        mfcc_tot.append(mfcc_pad)
-        data_tot.append(data_pad)
-
-        audio_pad_np = np.array(audio_pad)
-        audio_pad_pt = processor(audio_pad_np, sampling_rate=16000, return_tensors="pt").input_values
-        audio_pad_pt = audio_pad_pt.view(-1)
-        audio_pad_pt_np = audio_pad_pt.cpu().detach().numpy()
-        audio_tot.append(audio_pad_pt_np)
+
+        audio_pad_pt = processor(audio_pad, sampling_rate=16000, return_tensors="pt").input_values
+        audio_tot[i] = audio_pad_pt.view(-1).cpu().detach().numpy()
         
         # Update variables
         start = end
@@ -302,30 +785,321 @@ def segment_nd_features(input_values, mfcc, data, emotion, segment_size):
         start_wav = end_wav
         end_wav = min(time_wav, end_wav + segment_size_wav)      
     
-    mfcc_tot = np.stack(mfcc_tot)
-    data_tot = np.stack(data_tot)
-    audio_tot = np.stack(audio_tot)
     utt_label = emotion
     segment_labels = [emotion] * num_segs
-    
-    #Transpose output to N,C,F,T
-    data_tot = data_tot.transpose(0,1,3,2)
 
     return (num_segs, data_tot, segment_labels, utt_label, mfcc_tot, audio_tot)
 
+class StftFramer():
+    '''
+    Centred STFT frames of a growing signal.
+
+    Matches librosa.stft(center=True, pad_mode='constant'): the signal is preceded
+    by n_fft//2 zeros, and finish() appends n_fft//2 zeros. Only the samples not
+    yet consumed by a frame are buffered.
+    '''
+    def __init__(self, n_fft, hop_length, win_length=None, window='hann'):
+        self.n_fft = n_fft
+        self.hop_length = hop_length
+        self.win_length = win_length
+        self.window = window
+        self.buffer = np.zeros(n_fft // 2, dtype=np.float32)
+        self.offset = 0         # position of buffer[0] in the padded signal
+        self.num_frames = 0     # frames computed so far
+
+    def push(self, y, final=False):
+        '''
+        Add samples and return the complex STFT of the frames completed by them, (F, t).
+        '''
+        parts = [self.buffer, y]
+        if final:
+            parts.append(np.zeros(self.n_fft // 2, dtype=np.float32))
+        self.buffer = np.concatenate(parts)
+
+        end = self.offset + len(self.buffer)
+        available = (end - self.n_fft) // self.hop_length + 1 if end >= self.n_fft else 0
+        if available <= self.num_frames:
+            return np.zeros((1 + self.n_fft // 2, 0), dtype=np.complex64)
+
+        start = self.num_frames * self.hop_length - self.offset
+        stop = (available - 1) * self.hop_length + self.n_fft - self.offset
+        S = librosa.stft(self.buffer[start:stop], n_fft=self.n_fft, hop_length=self.hop_length,
+                         win_length=self.win_length, window=self.window, center=False)
+        self.num_frames = available
+
+        # Drop the samples no later frame needs
+        consumed = self.num_frames * self.hop_length - self.offset
+        self.buffer = self.buffer[consumed:]
+        self.offset += consumed
+        return S
+
+
+class DbAccumulator():
+    '''
+    Power frames in dB, referenced at the end like librosa.power_to_db.
+
+    ref: 'max' for ref=np.max, or a fixed reference power.
+    The raw 10*log10 frames and the running maxima are kept so that the final
+    reference and top_db clipping give the same values as the batch path.
+    store: if False, push() only returns the raw frames and the caller keeps them.
+    '''
+    def __init__(self, ref='max', amin=1e-10, top_db=80.0, keep_bins=None, store=True):
+        self.ref = ref
+        self.amin = amin
+        self.top_db = top_db
+        self.keep_bins = keep_bins
+        self.store = store
+        self.ref_value = None
+        self.raw_max = None
+        self.frames = []
+        self.base = 0          # index of the first kept frame
+        self.total = 0         # number of frames pushed
+
+    def push(self, power):
+        '''
+        Add power frames (F, t), return their raw dB.
+        '''
+        if power.shape[-1] == 0:
+            return None
+        if self.ref == 'max':
+            block_ref = power.max()
+            self.ref_value = block_ref if self.ref_value is None else max(self.ref_value, block_ref)
+        raw = self.raw(power)
+        self.raw_max = raw.max() if self.raw_max is None else max(self.raw_max, raw.max())
+        if self.keep_bins is not None:
+            raw = raw[:self.keep_bins]
+        if self.store:
+            self.frames.append(raw)
+        self.total += raw.shape[-1]
+        return raw
+
+    def raw(self, power):
+        '''
+        Raw dB of power frames, without recording them.
+        '''
+        return 10.0 * np.log10(np.maximum(self.amin, power))
+
+    def finalize(self, raw):
+        '''
+        Apply the reference and top_db known so far to raw dB frames.
+        '''
+        ref_value = self.ref if self.ref != 'max' else self.ref_value
+        ref_db = 10.0 * np.log10(np.maximum(self.amin, ref_value))
+        # Same operations and dtypes as librosa.power_to_db
+        log_spec = raw.copy()
+        log_spec -= ref_db
+        if self.top_db is not None:
+            max_db = np.array([self.raw_max], dtype=raw.dtype)
+            max_db -= ref_db
+            log_spec = np.maximum(log_spec, max_db[0] - self.top_db)
+        return log_spec
+
+    def get(self, start, end):
+        '''
+        dB frames [start, end) with the reference known so far.
+        '''
+        raw = np.concatenate(self.frames, axis=-1) if len(self.frames) > 1 else self.frames[0]
+        self.frames = [raw]
+        return self.finalize(raw[:, start - self.base:end - self.base])
+
+    def trim(self, start):
+        '''
+        Forget the frames before <start>.
+        '''
+        if start > self.base and self.frames:
+            raw = np.concatenate(self.frames, axis=-1)
+            self.frames = [raw[:, start - self.base:]]
+            self.base = start
+
+
+def stft_block_supported(sr, params):
+    '''
+    Whether the spectrogram frames of a file at <sr> are aligned with the mfcc
+    frames (hop of 160 samples), as the chunked and streaming paths require.
+    '''
+    return int((params['hop_length']/1000) * sr) == 160
+
+
+def segment_ranges(time, segment_size):
+    '''
+    (start, end) of every segment, as iterated by segment_nd_features.
+    '''
+    ranges = []
+    start, end = 0, segment_size
+    for i in range(math.ceil(time / segment_size)):
+        if end > time:
+            end = time
+            start = max(0, end - segment_size)
+        ranges.append((start, end))
+        start = end
+        end = min(time, end + segment_size)
+    return ranges
+
+
+def wav_segment_ranges(num_samples, segment_size_wav, num_segs):
+    '''
+    (start, end) of the audio of every segment, as iterated by segment_nd_features.
+    '''
+    ranges = []
+    start_wav, end_wav = 0, segment_size_wav
+    for i in range(num_segs):
+        if end_wav > num_samples:
+            end_wav = num_samples
+            start_wav = max(0, end_wav - segment_size_wav)
+        ranges.append((start_wav, end_wav))
+        start_wav = end_wav
+        end_wav = min(num_samples, end_wav + segment_size_wav)
+    return ranges
+
+
+def segment_valid_samples(file_list, seg_num, durations, params):
+    '''
+    Number of valid (not padded) samples of every seg_audio row of one speaker,
+    from the header durations of its files.
+    '''
+    segment_size_wav = params['segment_size'] * 160
+    lengths = [end - start
+               for (wav_path, _), num_segs in zip(file_list, seg_num)
+               for start, end in wav_segment_ranges(durations[wav_path][0], segment_size_wav, int(num_segs))]
+    return np.asarray(lengths, dtype=np.int64)
+
+
+def extract_utterance_chunked(x, sr, emotion, features, params, out=None):
+    '''
+    Same output as segment_signal, with the STFTs computed in blocks of
+    params['stft_block'] frames. <x> is the pre-emphasized signal.
+
+    Each block is reduced to dB right away and scattered into the segment buffers,
+    so the complex STFTs of the whole file are never held in memory. The reference
+    (ref=np.max) and top_db clipping are applied in place once the whole file has
+    been seen. The mfcc top_db clipping is relative to the maximum of the whole
+    file and comes before the DCT, so the mfcc STFT is computed in two passes over
+    the blocks: the first finds the maximum, the second clips, applies the DCT and
+    scatters each block. Besides the outputs, memory is bounded by one block.
+    Only 'logspec' and 'logmelspec' are supported: the deltas of 'logdeltaspec'
+    need the whole spectrogram. The spectrogram hop must be the 160 samples of
+    the mfcc (eg. 10 ms at 16 kHz), see stft_block_supported.
+    '''
+    if features not in ('logspec', 'logmelspec'):
+        raise ValueError(f'Chunked extraction does not support <{features}> features')
+    if not stft_block_supported(sr, params):
+        raise ValueError(f'Chunked extraction needs a hop of 160 samples, got '
+                         f'{int((params["hop_length"]/1000) * sr)} at {sr} Hz')
+    segment_size = params['segment_size']
+    segment_size_wav = segment_size * 160
+    block_frames = params['stft_block']
+
+    win_length = int((params['win_length']/1000) * sr)
+    hop_length = int((params['hop_length']/1000) * sr)
+    time = 1 + len(x) // hop_length
+    ranges = segment_ranges(time, segment_size)
+    num_segs = len(ranges)
+
+    if out is None:
+        nch, nfreq = feature_dims(features, params)
+        out = (np.empty((num_segs, nch, nfreq, segment_size), dtype=np.float32),
+               np.empty((num_segs, segment_size, 40), dtype=np.float32),
+               np.empty((num_segs, segment_size_wav), dtype=np.float32))
+    data_tot, mfcc_tot, audio_tot = out
+    assert data_tot.shape[0] == num_segs, \
+        f"{data_tot.shape[0]} output slots for {num_segs} segments"
+    data_tot[...] = 0
+    mfcc_tot[...] = 0
+
+    spec_framer = StftFramer(params['ndft'], hop_length, win_length,
+                             FEATURE_BANK.window(params['window'], win_length))
+    if features == 'logspec':
+        spec_db = DbAccumulator(ref='max', keep_bins=params['nfreq'], store=False)
+    else:
+        mel_basis = FEATURE_BANK.mel(sr, params['ndft'], params['nmel'])
+        spec_db = DbAccumulator(ref='max', store=False)
+    # librosa.feature.mfcc(y, sr, n_mfcc=40, hop_length=160, htk=True)
+    mfcc_framer = StftFramer(2048, 160, window=FEATURE_BANK.window('hann', 2048))
+    mfcc_basis = FEATURE_BANK.mel(sr, 2048, 128, htk=True)
+    mfcc_db = DbAccumulator(ref=1.0, store=False)
+    dct = FEATURE_BANK.dct(128, 40)
+
+    def scatter(block, t0, dest):
+        # Copy frames [t0, t0 + block.shape[-1]) into every segment they belong to
+        t1 = t0 + block.shape[-1]
+        for i, (start, end) in enumerate(ranges):
+            lo, hi = max(start, t0), min(end, t1)
+            if lo < hi:
+                dest(i, lo - start, hi - start, block[..., lo - t0:hi - t0])
+
+    def to_spec(i, lo, hi, frames):
+        data_tot[i, 0, :, lo:hi] = frames
+
+    def to_mfcc(i, lo, hi, frames):
+        mfcc_tot[i, lo:hi] = frames.T
+
+    def mfcc_blocks():
+        # Mel power of the mfcc STFT, one block of samples at a time
+        framer = StftFramer(2048, 160, window=FEATURE_BANK.window('hann', 2048))
+        for i in range(0, len(x) + 1, block_wav):
+            final = i + block_wav > len(x)
+            S = framer.push(x[i:i + block_wav], final=final)
+            yield np.einsum("...ft,mf->...mt", np.abs(S) ** 2.0, mfcc_basis, optimize=True)
+            if final:
+                break
+
+    # First pass: spectrogram blocks and the maximum of the mfcc mel frames
+    block_wav = block_frames * hop_length
+    for i in range(0, len(x) + 1, block_wav):
+        final = i + block_wav > len(x)
+        S = spec_framer.push(x[i:i + block_wav], final=final)
+        if features == 'logspec':
+            power = np.square(np.abs(S))
+        else:
+            power = np.einsum("...ft,mf->...mt", np.abs(S) ** 2.0, mel_basis, optimize=True)
+        t0 = spec_db.total
+        raw = spec_db.push(power)
+        if raw is not None:
+            scatter(raw, t0, to_spec)
+        if final:
+            break
+    for power in mfcc_blocks():
+        mfcc_db.push(power)
+    assert spec_db.total == mfcc_db.total == time
+
+    # Second pass: clip the mfcc mel frames with the maximum of the whole file, then DCT
+    t0 = 0
+    for power in mfcc_blocks():
+        if power.shape[-1] == 0:
+            continue
+        scatter(dct @ mfcc_db.finalize(mfcc_db.raw(power)), t0, to_mfcc)
+        t0 += power.shape[-1]
+
+    # Apply the reference and top_db of the whole file, leaving the padding at 0
+    for i, (start, end) in enumerate(ranges):
+        view = data_tot[i, 0, :, :end - start]
+        view[...] = spec_db.finalize(view)
+
+    processor = FEATURE_BANK.processor()
+    audio_pad = np.zeros(segment_size_wav, dtype=x.dtype)
+    for i, (start_wav, end_wav) in enumerate(wav_segment_ranges(len(x), segment_size_wav, num_segs)):
+        audio_pad[:segment_size_wav - (end_wav - start_wav)] = 0
+        audio_pad[segment_size_wav - (end_wav - start_wav):] = x[start_wav:end_wav]
+        audio_pad_pt = processor(audio_pad, sampling_rate=16000, return_tensors="pt").input_values
+        audio_tot[i] = audio_pad_pt.view(-1).cpu().detach().numpy()
+
+    return (num_segs, data_tot, [emotion] * num_segs, emotion, mfcc_tot, audio_tot)
+
+
 #Feature extraction function map
 GET_FEATURES = {'logspec': extract_logspec,
                 'logmelspec': extract_logmelspec,
                 'logdeltaspec': extract_logdeltaspec
                 }
 
-def add_gaussian_noise(signal, snr_db):
+def add_gaussian_noise(signal, snr_db, rng=None):
     """
     给音频信号添加高斯噪声，以信噪比(SNR)控制噪声强度
     
     参数:
         signal: 原始音频信号（numpy数组）
         snr_db: 信噪比(dB)，值越大噪声越小，值越小噪声越大
+        rng: 每条语音自己的随机数生成器(utterance_rng)，None则使用np.random全局状态
         
     返回:
         noisy_signal: 带噪声的音频信号
@@ -338,7 +1112,7 @@ def add_gaussian_noise(signal, snr_db):
     noise_power = signal_power / (10 ** (snr_db / 10))
     
     # 生成高斯噪声（均值为0，方差为噪声功率）
-    noise = np.random.normal(0, np.sqrt(noise_power), len(signal))
+    noise = (np.random if rng is None else rng).normal(0, np.sqrt(noise_power), len(signal))
     
     # 添加噪声到信号
     noisy_signal = signal + noise
@@ -351,6 +1125,33 @@ def add_gaussian_noise(signal, snr_db):
     return noisy_signal
 
 
+def add_gaussian_noise_multi(signal, snr_list, rng=None):
+    '''
+    add_gaussian_noise at several SNRs at once.
+
+    The signal power and peak are computed once and the noise of all SNRs is drawn
+    as one (len(snr_list), len(signal)) matrix.
+    Returns the noisy signals, shape (len(snr_list), len(signal)), in the dtype of <signal>.
+    '''
+    snr_db = np.asarray(snr_list, dtype=np.float64)
+
+    # Signal power and peak, once for every SNR
+    signal_power = np.mean(signal ** 2)
+    max_amplitude = np.max(np.abs(signal))
+
+    # Noise power of every SNR (SNR = 10*log10(signal_power/noise_power))
+    noise_power = signal_power / (10 ** (snr_db / 10))
+    noise = (np.random if rng is None else rng).standard_normal((len(snr_db), len(signal)))
+    noisy_signal = signal[None, :] + noise * np.sqrt(noise_power)[:, None]
+
+    # Rescale the versions that exceed the amplitude range of the original signal
+    noisy_max = np.max(np.abs(noisy_signal), axis=1)
+    scale = np.where(noisy_max > max_amplitude, max_amplitude / np.maximum(noisy_max, 1e-12), 1.0)
+    noisy_signal *= scale[:, None]
+
+    return noisy_signal.astype(signal.dtype)
+
+
 # if __name__ == '__main__':
 #     #test
 #     sig,sr = librosa.load('noise_wav/presto.wav', sr=None)
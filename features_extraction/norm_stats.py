@@ -0,0 +1,90 @@
+'''
+Author: Shihe Dong
+Description: Streaming normalization statistics of the extracted features.
+Per-bin mean/std accumulated with Welford updates and Chan's parallel merge,
+so statistics of speakers, workers and resumed runs can be combined exactly.
+'''
+import numpy as np
+
+
+class RunningStats():
+    '''
+    Count, mean and sum of squared deviations (M2) of vectors of shape <shape>.
+    '''
+    def __init__(self, shape, count=0, mean=None, m2=None):
+        self.shape = tuple(shape)
+        self.count = count
+        self.mean = np.zeros(self.shape) if mean is None else np.asarray(mean, dtype=np.float64).reshape(self.shape)
+        self.m2 = np.zeros(self.shape) if m2 is None else np.asarray(m2, dtype=np.float64).reshape(self.shape)
+
+    def _merge(self, count, mean, m2):
+        if count == 0:
+            return
+        if self.count == 0:
+            self.count, self.mean, self.m2 = count, mean, m2
+            return
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean = self.mean + delta * (count / total)
+        self.m2 = self.m2 + m2 + delta ** 2 * (self.count * count / total)
+        self.count = total
+
+    def update(self, x):
+        '''
+        Add samples x of shape (n, *shape).
+        '''
+        if len(x) == 0:
+            return
+        x = np.asarray(x, dtype=np.float64)
+        mean = x.mean(axis=0)
+        self._merge(len(x), mean, ((x - mean) ** 2).sum(axis=0))
+
+    def merge(self, other):
+        self._merge(other.count, other.mean, other.m2)
+        return self
+
+    @property
+    def std(self):
+        return np.sqrt(self.m2 / max(self.count, 1))
+
+    def to_dict(self):
+        return {'shape': list(self.shape), 'count': int(self.count),
+                'mean': self.mean.tolist(), 'std': self.std.tolist(), 'm2': self.m2.tolist()}
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(d['shape'], d['count'], d['mean'], d['m2'])
+
+
+def update_segment_stats(stats, seg_spec, seg_mfcc, valid):
+    '''
+    Add the frames of the segments of one utterance, without their padding.
+    seg_spec: (N, C, F, T), seg_mfcc: (N, T, n_mfcc), valid: number of valid frames
+    of every segment in both fields (only segments of utterances shorter than T are padded).
+    stats: {'seg_spec': RunningStats((C, F)), 'seg_mfcc': RunningStats((n_mfcc,))}
+    '''
+    stats['seg_spec'].update(np.moveaxis(seg_spec[..., :valid], -1, 1).reshape(-1, *seg_spec.shape[1:3]))
+    stats['seg_mfcc'].update(seg_mfcc[:, :valid].reshape(-1, seg_mfcc.shape[-1]))
+
+
+def summarize_stats(speaker_stats, previous=None):
+    '''
+    Per-speaker and global statistics, as stored in the output manifest.
+    speaker_stats: {speaker: {field: RunningStats}}
+    previous: a summary of an earlier run; its speakers that are not in
+              <speaker_stats> are kept and merged into the global statistics.
+    '''
+    speakers = {}
+    if previous is not None:
+        for speaker_id, fields in previous['speakers'].items():
+            speakers[speaker_id] = {f: RunningStats.from_dict(d) for f, d in fields.items()}
+    speakers.update(speaker_stats)
+
+    total = {}
+    for fields in speakers.values():
+        for field, s in fields.items():
+            if field not in total:
+                total[field] = RunningStats(s.shape)
+            total[field].merge(s)
+    return {'global': {f: s.to_dict() for f, s in total.items()},
+            'speakers': {sp: {f: s.to_dict() for f, s in fields.items()} for sp, fields in speakers.items()}}
@@ -9,14 +9,23 @@ import sys
 import argparse
 import numpy as np
 import pickle
-from features_util import extract_features
+from features_util import extract_features, stft_block_supported
 from collections import Counter
 import pandas as pd
-from database import SER_DATABASES
+from database import SER_DATABASES, get_durations, get_speaker_texts, get_fingerprints, find_duplicates
+from feature_store import save_feature_dir, save_manifest, load_manifest, load_feature_dir
+from split_index import build_index, save_index
+from norm_stats import summarize_stats
+import json
 import random
 
 
-def main(args):
+def main(args, pool=None):
+    '''
+    Extract and save the features of one dataset/configuration.
+    pool: optional process pool shared by several jobs (see run_jobs.py).
+    Returns a summary of the job: files, audio seconds and segments extracted.
+    '''
     
     #Get spectrogram parameters
     params={'window'        : args.window,
@@ -26,16 +35,28 @@ def main(args):
             'nfreq'         : args.nfreq,
             'nmel'          : args.nmel,
             'segment_size'  : args.segment_size,
-            'mixnoise'      : args.mixnoise
+            'mixnoise'      : args.mixnoise,
+            'prefetch'      : args.prefetch,
+            'num_workers'   : args.num_workers,
+            'memmap_dir'    : args.memmap_dir,
+            'stft_block'    : args.stft_block,
+            'backend'       : args.backend,
+            'batch_size'    : args.batch_size,
+            'torch_threads' : args.torch_threads,
+            'snr_list'      : args.snr_list,
+            'seed'          : args.seed,
+            'audio_cache'   : args.audio_cache
             }
     
     dataset  = args.dataset
     features = args.features
     dataset_dir = args.dataset_dir
-    mixnoise = args.mixnoise
+    mixnoise = args.mixnoise or bool(args.snr_list)
 
     if args.save_dir is not None:
-        out_filename = args.save_dir+dataset+'_'+args.save_label +'.pkl'
+        out_filename = args.save_dir+dataset+'_'+args.save_label
+        if args.save_format == 'pkl':
+            out_filename += '.pkl'
     else:
         out_filename = 'None'
 
@@ -53,7 +74,7 @@ def main(args):
     print('\n')
 
     # Random seed
-    seed_everything(111)
+    seed_everything(args.seed)
 
     if dataset == 'IEMOCAP':
         # This is the 4-class, improvised data set
@@ -92,18 +113,120 @@ def main(args):
         emot_map={'neu':0, 'hap':1, 'sad':2, 'ang':3, 'sur':4, 'fea':5, 'dis':6}
         database = SER_DATABASES[dataset](dataset_dir,emotion_map=emot_map)
 
+    #BERT needs the transcript of every utterance, check before the extraction
+    if args.bert_model is not None and not hasattr(database, 'utterance_text'):
+        raise ValueError('--bert_model requires a dataset with utterance texts (MELD), got ' + dataset)
+
     #Get file paths and label in database
     speaker_files = database.get_files()
 
+    #Read audio lengths from the WAV headers
+    durations = get_durations(speaker_files, cache_path=args.index_cache)
+
+    #The torch backend computes whole-file STFTs in batches
+    if args.stft_block and args.backend == 'torch':
+        raise ValueError('--stft_block is not supported by --backend torch')
+
+    #The chunked STFTs need spectrogram frames aligned with the mfcc frames
+    if args.stft_block:
+        rates = sorted({durations[wav_path][1] for files in speaker_files.values()
+                        for wav_path, _ in files if not stft_block_supported(durations[wav_path][1], params)})
+        if rates:
+            raise ValueError(f'--stft_block needs a hop of 160 samples; --hop_length {args.hop_length}'
+                             f' gives another hop for the files at {rates} Hz')
+
+    #Only the new or modified files with --update
+    extract_files = speaker_files
+    if args.update:
+        from feature_update import check_compatible, diff_files, update_feature_dir
+        if args.save_format != 'npy' or args.save_dir is None:
+            raise ValueError('--update requires --save_format npy and --save_dir')
+        previous = load_manifest(out_filename)
+        check_compatible(previous, features, params)
+        diff = diff_files(previous, speaker_files)
+        extract_files = diff['extract']
+        print(f'UPDATE: {diff["new"]} new, {diff["modified"]} modified, {diff["removed"]} removed,'
+              f' {diff["unchanged"]} unchanged files; {len(diff["reuse"])} speaker shards to rewrite,'
+              f' {len(diff["removed_speakers"])} speakers removed\n')
+
+    #Duplicated audio is extracted once
+    duplicates, dedup_report = None, None
+    if args.dedup != 'none':
+        spectral = args.dedup == 'spectral'
+        fingerprints = get_fingerprints(extract_files, cache_path=args.index_cache, spectral=spectral)
+        duplicates, dedup_report = find_duplicates(extract_files, fingerprints, durations, spectral=spectral)
+        print(f'DEDUP: {dedup_report["num_duplicates"]} duplicates of {dedup_report["num_groups"]} files,'
+              f' {dedup_report["saved_seconds"]:.1f} s of {dedup_report["audio_seconds"]:.1f} s audio'
+              f' not extracted ({dedup_report["saved_fraction"]:.1%})\n')
+
     #Extract features
-    features_data = extract_features(speaker_files, features, params)
+    speaker_stats = {}
+    features_data = extract_features(extract_files, features, params, durations, stats=speaker_stats,
+                                     duplicates=duplicates, pool=pool)
+    summary = {'dataset': dataset, 'features': features, 'output': out_filename,
+               'num_files': sum(len(files) for files in extract_files.values()),
+               'audio_seconds': sum(durations[wav_path][0] / durations[wav_path][1]
+                                    for files in extract_files.values() for wav_path, _ in files),
+               'num_segments': int(sum(np.sum(features_data[s]["seg_num"], dtype=np.int64)
+                                       for s in features_data))}
+    stats = summarize_stats(speaker_stats)
+
+    #wav2vec2 embeddings of seg_audio
+    if args.w2v_model is not None or args.w2v_tiny:
+        from wav2vec_features import load_wav2vec2, add_wav2vec2_features
+        w2v_model = load_wav2vec2(args.w2v_model, tiny=args.w2v_tiny)
+        add_wav2vec2_features(features_data, w2v_model, extract_files, durations, params,
+                              layers=args.w2v_layers, batch_size=args.w2v_batch_size, num_threads=args.torch_threads,
+                              cache_dir=args.w2v_cache)
     # print(type(features_data["3M"]))
     
+    #BERT embeddings of the utterance texts
+    if args.bert_model is not None:
+        from text_features import load_bert, add_text_features
+        tokenizer, bert_model = load_bert(args.bert_model)
+        add_text_features(features_data, get_speaker_texts(database, extract_files), tokenizer, bert_model,
+                          num_threads=args.torch_threads)
+
     #Save features
     if args.save_dir is not None:
         
-        with open(out_filename, "wb") as fout:
-                pickle.dump(features_data, fout)
+        if args.save_format == 'npy':
+            encodings = dict(e.split('=') for e in args.encoding)
+            max_error = {f: float(v) for f, v in (e.split('=') for e in args.max_quant_error)}
+            if args.update:
+                update_feature_dir(out_filename, previous, diff, features_data, speaker_files, durations,
+                                   features, params, encodings=encodings, max_error=max_error)
+                # Every speaker, for the index and the statistics below
+                features_data = load_feature_dir(out_filename, decode=False)
+                manifest = load_manifest(out_filename)
+            else:
+                manifest = save_feature_dir(features_data, out_filename,
+                                            meta={'dataset': dataset, 'features': features, 'params': params,
+                                                  'encodings': encodings},
+                                            encodings=encodings, max_error=max_error,
+                                            speaker_files=speaker_files)
+                manifest['stats'] = stats
+                save_manifest(manifest, out_filename)
+            index_filename = os.path.join(out_filename, 'index.json')
+        else:
+            with open(out_filename, "wb") as fout:
+                    pickle.dump(features_data, fout)
+            with open(out_filename[:-len('.pkl')] + '_stats.json', "w", encoding="utf-8") as fout:
+                json.dump(stats, fout)
+            index_filename = out_filename[:-len('.pkl')] + '_index.json'
+
+        #Segment ranges per speaker, fold and official split
+        save_index(build_index(features_data, speaker_files, dataset, database), index_filename)
+        if dedup_report is not None:
+            with open(index_filename[:-len('index.json')] + 'duplicates.json', "w", encoding="utf-8") as fout:
+                json.dump(dedup_report, fout, indent=2)
+
+    #Tar shards for sequential reading, see tar_shards.TarShardDataset
+    if args.export_shards is not None:
+        from tar_shards import write_shards
+        shards = write_shards(features_data, speaker_files, args.export_shards, shard_size=args.shard_size,
+                              seed=args.seed, manifest=manifest if args.update else None)
+        print(f'{len(shards)} shards written to {args.export_shards}')
 
     #Print classes statistic
         
@@ -142,6 +265,7 @@ def main(args):
     print('\n')
     print('*'*50)
     print('\n')
+    return summary
 
 
 
@@ -195,8 +319,75 @@ def parse_arguments(argv):
 
     parser.add_argument('--mixnoise', action='store_true',
         help='Set this flag to mix with noise.')
+
+    parser.add_argument('--snr_list', type=float, nargs='+', default=None,
+        help='SNRs (dB) of the Gaussian noise versions, eg. --snr_list 0 5 10 20.'
+             '  Each file is decoded once and seg_spec/seg_mfcc/seg_audio become'
+             '  lists with one array per SNR. Implies --mixnoise.')
+
+    parser.add_argument('--seed', type=int, default=111,
+        help='Root random seed. The noise of each utterance is drawn from a generator'
+             '  derived from this seed and the utterance file, see utterance_rng.')
+
+    #PERFORMANCE
+    parser.add_argument('--prefetch', type=int, default=4,
+        help='Number of audio files decoded ahead in background threads.'
+             '  0 disables prefetching.')
+
+    parser.add_argument('--num_workers', type=int, default=1,
+        help='Number of worker processes. Files are scheduled longest first.')
+
+    parser.add_argument('--audio_cache', type=str, default=None,
+        help='Directory of decoded audio (.npz), reused by later runs on the same corpus.')
+
+    parser.add_argument('--index_cache', type=str, default=None,
+        help='Path to a json file caching the audio lengths of the dataset index.')
+
+    parser.add_argument('--memmap_dir', type=str, default=None,
+        help='Directory to memory-map the output arrays into (<speaker>_<field>.npy).'
+             '  Default: arrays are kept in memory.')
+
+    parser.add_argument('--stft_block', type=int, default=0,
+        help='Compute the STFTs in blocks of this many frames to bound memory on long'
+             '  recordings (librosa backend and logspec/logmelspec only, and a 160-sample'
+             '  hop: 10 ms at 16 kHz).'
+             '  Besides the outputs, memory is bounded by one block; the mfcc STFT is'
+             '  computed twice. 0 computes the whole file at once.')
+
+    parser.add_argument('--backend', type=str, default='librosa',
+        help='Spectrogram backend. Options:'
+             '  - librosa (default) : one utterance at a time'
+             '  - torch             : batched CPU torch.stft, see torch_backend.py')
+
+    parser.add_argument('--batch_size', type=int, default=16,
+        help='Utterances per batch of the torch backend.')
+
+    parser.add_argument('--torch_threads', type=int, default=0,
+        help='torch CPU threads of the torch backend. 0 keeps the torch default.')
     
 
+    #WAV2VEC2 EMBEDDINGS
+    parser.add_argument('--w2v_model', type=str, default=None,
+        help='Path to a local wav2vec2 checkpoint. If set, the hidden states of seg_audio'
+             '  are stored as seg_w2v.')
+
+    parser.add_argument('--w2v_tiny', action='store_true',
+        help='Use a tiny randomly initialized wav2vec2 instead (offline tests).')
+
+    parser.add_argument('--w2v_layers', type=int, nargs='+', default=[-1],
+        help='hidden_states layers to keep. Default: last layer')
+
+    parser.add_argument('--w2v_batch_size', type=int, default=16,
+        help='Segments per wav2vec2 batch.')
+
+    parser.add_argument('--w2v_cache', type=str, default=None,
+        help='Directory of the content-hash cache of wav2vec2 embeddings.')
+
+    #TEXT FEATURES
+    parser.add_argument('--bert_model', type=str, default=None,
+        help='Path to a local BERT checkpoint. If set (MELD only), the pooled BERT'
+             '  embeddings of the utterance texts are stored as utter_text.')
+
     #FEATURES FILE
     parser.add_argument('--save_dir', type=str, default='G:\dsh_postgraduate\Other_Speech_model\CMTNET_Experiment_Paper\different_SNR\\',
         help='Path to directory to save the extracted features.')
@@ -204,6 +395,40 @@ def parse_arguments(argv):
     parser.add_argument('--save_label', type=str, default='nodb',
         help='Label to save the feature')
 
+    parser.add_argument('--save_format', type=str, default='pkl',
+        help='Output format. Options:'
+             '  - pkl (default) : one pickle of the speaker dict'
+             '  - npy           : one directory with <speaker>/<field>.npy and manifest.json,'
+             '                    readable lazily by ser_dataset.SERFeatureDataset')
+
+    parser.add_argument('--dedup', type=str, default='none',
+        help='Extract duplicated audio only once. Options:'
+             '  - none (default)'
+             '  - pcm      : identical decoded PCM'
+             '  - spectral : also near-identical audio of the same length (coarse spectral fingerprint)'
+             '  The duplicates found are reported in duplicates.json next to the index.')
+
+    parser.add_argument('--export_shards', type=str, default=None,
+        help='Also write the segments into tar shards in this directory, in a shuffled'
+             '  order fixed by --seed (<key>.seg_spec.npy, .seg_mfcc.npy, .seg_audio.npy, .json).')
+
+    parser.add_argument('--shard_size', type=int, default=1000,
+        help='Number of samples per tar shard.')
+
+    parser.add_argument('--update', action='store_true',
+        help='With --save_format npy, update the previous output in place: only new or'
+             '  modified files are extracted, removed files are dropped and only the'
+             '  affected speaker shards are rewritten.')
+
+    parser.add_argument('--encoding', type=str, nargs='+', default=[],
+        help='Storage encoding per field with --save_format npy, eg. seg_spec=q8 seg_audio=float16.'
+             '  Options: float32 (default), float16, q16, q8 (linear quantization,'
+             '  error <= (max - min) / (2 * (2**bits - 1)), see feature_store.py)')
+
+    parser.add_argument('--max_quant_error', type=str, nargs='+', default=[],
+        help='Largest allowed dequantization error per field, eg. seg_spec=0.5.'
+             '  Saving fails if an encoding exceeds it.')
+
     return parser.parse_args(argv)
 
 
@@ -219,6 +444,4 @@ def seed_everything(seed):
 
 
 if __name__ == '__main__':
-    args = parse_arguments(sys.argv[1:])
-    args.dataset = 'MELD'
     main(parse_arguments(sys.argv[1:]))
\ No newline at end of file
@@ -0,0 +1,148 @@
+'''
+Author: Shihe Dong
+Description: Run several feature extractions from one job file.
+All jobs share one worker pool, and jobs on the same corpus share its index
+cache (--index_cache) and decoded audio cache (--audio_cache), so the second
+configuration of a corpus does not decode the audio again.
+
+    python run_jobs.py jobs.yaml --num_workers 8 --cache_dir ./cache
+
+Job file (YAML or JSON), keys are run_extract_features.py argument names:
+    defaults:                       # options of every job
+      save_dir: /data/features/
+      save_format: npy
+    matrix:                         # optional, every combination with every job
+      features: [logspec, logmelspec]
+    jobs:
+      - {dataset: IEMOCAP, dataset_dir: /data/IEMOCAP}
+      - {dataset: MELD, dataset_dir: /data/MELD.Raw}
+Without an explicit save_label, the matrix values name the outputs, eg. IEMOCAP_logspec.
+'''
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+import itertools
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+
+from run_extract_features import main, parse_arguments
+
+
+def load_job_file(path):
+    with open(path, 'r', encoding='utf-8') as fin:
+        if os.path.splitext(path)[1] in ('.yaml', '.yml'):
+            import yaml
+            return yaml.safe_load(fin)
+        return json.load(fin)
+
+
+def expand_jobs(spec):
+    '''
+    List of option dicts, one per job: defaults, then the job, then the matrix combination.
+    '''
+    defaults = spec.get('defaults', {})
+    matrix = spec.get('matrix', {})
+    combos = [dict(zip(matrix.keys(), values)) for values in itertools.product(*matrix.values())]
+    jobs = []
+    for job in spec.get('jobs', [{}]):
+        for combo in combos:
+            options = {**defaults, **job, **combo}
+            if combo and 'save_label' not in job and 'save_label' not in defaults:
+                options['save_label'] = '_'.join(str(v) for v in combo.values())
+            jobs.append(options)
+    return jobs
+
+
+def job_args(options):
+    '''
+    run_extract_features.py arguments of a job: its defaults, overridden by <options>.
+    '''
+    args = parse_arguments([])
+    for key, value in options.items():
+        if not hasattr(args, key):
+            raise ValueError(f'Unknown option <{key}> in job {options}')
+        setattr(args, key, value)
+    return args
+
+
+def corpus_key(args):
+    return f'{args.dataset}_{hashlib.sha1(str(args.dataset_dir).encode("utf-8")).hexdigest()[:8]}'
+
+
+def run_jobs(jobs, num_workers=1, cache_dir=None):
+    '''
+    Run the jobs over one shared process pool, grouped by corpus.
+    Returns one summary per job with its wall time and throughput.
+    '''
+    all_args = [job_args(options) for options in jobs]
+    outputs = [args.save_dir + args.dataset + '_' + args.save_label for args in all_args
+               if args.save_dir is not None]
+    duplicated = sorted({o for o in outputs if outputs.count(o) > 1})
+    if duplicated:
+        raise ValueError(f'Several jobs write to {duplicated}, set save_label')
+
+    # Jobs on the same corpus run back to back, their caches stay warm
+    first = {}
+    for args in all_args:
+        first.setdefault(corpus_key(args), len(first))
+    all_args.sort(key=lambda args: first[corpus_key(args)])
+
+    pool = ProcessPoolExecutor(max_workers=num_workers) if num_workers > 1 else None
+    summaries = []
+    try:
+        for args in all_args:
+            args.num_workers = num_workers
+            if cache_dir is not None:
+                if args.index_cache is None:
+                    args.index_cache = os.path.join(cache_dir, corpus_key(args) + '_index.json')
+                if args.audio_cache is None:
+                    args.audio_cache = os.path.join(cache_dir, corpus_key(args) + '_audio')
+            t0 = time.perf_counter()
+            try:
+                summary = main(args, pool=pool)
+                summary['status'] = 'ok'
+            except Exception as e:
+                traceback.print_exc()
+                summary = {'dataset': args.dataset, 'features': args.features, 'status': 'failed',
+                           'error': repr(e)}
+            wall = time.perf_counter() - t0
+            summary['save_label'] = args.save_label
+            summary['wall_seconds'] = wall
+            if summary['status'] == 'ok':
+                summary['files_per_second'] = summary['num_files'] / wall
+                summary['realtime_factor'] = summary['audio_seconds'] / wall
+            summaries.append(summary)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    return summaries
+
+
+def parse_jobs_arguments(argv):
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('job_file', type=str,
+        help='YAML or JSON job file, see the module docstring.')
+    parser.add_argument('--num_workers', type=int, default=1,
+        help='Size of the process pool shared by all jobs.')
+    parser.add_argument('--cache_dir', type=str, default=None,
+        help='Directory of the per-corpus index and decoded audio caches.')
+    parser.add_argument('--summary', type=str, default='jobs_summary.json',
+        help='Path of the JSON summary of the jobs.')
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    jobs_args = parse_jobs_arguments(sys.argv[1:])
+    t0 = time.perf_counter()
+    summaries = run_jobs(expand_jobs(load_job_file(jobs_args.job_file)),
+                         num_workers=jobs_args.num_workers, cache_dir=jobs_args.cache_dir)
+    with open(jobs_args.summary, 'w', encoding='utf-8') as fout:
+        json.dump({'total_wall_seconds': time.perf_counter() - t0, 'jobs': summaries}, fout, indent=2)
+
+    columns = ['dataset', 'features', 'save_label', 'status', 'num_files', 'num_segments',
+               'wall_seconds', 'files_per_second', 'realtime_factor']
+    print(pd.DataFrame(summaries).reindex(columns=columns).to_string(index=False))
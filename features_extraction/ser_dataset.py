@@ -0,0 +1,267 @@
+'''
+Author: Shihe Dong
+Description: PyTorch datasets over the extracted SER features.
+IEMOCAP/EMODB/RAVDESS/MELD
+'''
+import os
+import hashlib
+import json
+from collections import OrderedDict
+import numpy as np
+import torch
+from torch.utils.data import Dataset, DataLoader
+
+from feature_store import load_manifest, load_field, field_info, decode_field, snr_field
+from features_util import load_audio, extract_utterance, plan_segments, utterance_rng
+from database import get_durations
+
+
+class SERFeatureDataset(Dataset):
+    '''
+    Segment-level dataset reading a feature directory (see feature_store.py) lazily.
+
+    features_dir: directory written by save_feature_dir.
+    speakers: speaker IDs to include, eg. ['1M','1F',...]. Default: all.
+    exclude_speakers: speaker IDs to leave out, eg. the test speaker of a fold.
+    fields: per-segment fields returned by __getitem__.
+    segment_ranges: optional {speaker: [[start, end], ...]} selection of rows,
+                    eg. index['splits']['train'] from split_index.py.
+    snr: SNR version to read from a --snr_list output (default: the first SNR).
+
+    The arrays are opened as read-only memmaps on first access in each process,
+    so DataLoader workers share the page cache instead of copying the arrays.
+    Fields stored as float16/q16/q8 are dequantized to float32 per sample.
+    '''
+    def __init__(self, features_dir, speakers=None, exclude_speakers=None,
+                 fields=('seg_spec', 'seg_mfcc', 'seg_audio'), segment_ranges=None, snr=None):
+        self.features_dir = features_dir
+        self.fields = tuple(fields)
+        manifest = load_manifest(features_dir)
+
+        if speakers is None:
+            speakers = list(segment_ranges.keys()) if segment_ranges is not None else list(manifest['speakers'].keys())
+        if exclude_speakers is not None:
+            speakers = [s for s in speakers if s not in exclude_speakers]
+        self.speakers = list(speakers)
+
+        # Stored name of every field: the selected SNR version of --snr_list outputs
+        self.stored = {}
+        for s in self.speakers:
+            entry = manifest['speakers'][s]
+            self.stored[s] = {}
+            for field in self.fields:
+                if field not in entry['fields'] and 'snr_list' in entry:
+                    version = entry['snr_list'][0] if snr is None else snr
+                    if snr_field(field, version) not in entry['fields']:
+                        raise ValueError(f'No {field} at SNR {version} for speaker {s}, '
+                                         f'stored SNRs: {entry["snr_list"]}')
+                    self.stored[s][field] = snr_field(field, version)
+                else:
+                    self.stored[s][field] = field
+        self.field_info = {s: {field: field_info(manifest, s, self.stored[s][field]) for field in self.fields}
+                           for s in self.speakers}
+
+        # Global segment index -> (speaker, row)
+        rows = []
+        for s in self.speakers:
+            if segment_ranges is None:
+                rows.append(np.arange(manifest['speakers'][s]['num_segments']))
+            else:
+                rows.append(np.concatenate([np.arange(start, end) for start, end in segment_ranges[s]]
+                                           + [np.zeros(0, dtype=np.int64)]))
+        sizes = [len(r) for r in rows]
+        self.speaker_index = np.repeat(np.arange(len(self.speakers)), sizes)
+        self.row_index = np.concatenate(rows) if rows else np.zeros(0, dtype=np.int64)
+
+        # Labels are tiny, keep them in memory
+        self.labels = np.concatenate([np.asarray(load_field(features_dir, s, 'seg_label', mmap=False))[r]
+                                      for s, r in zip(self.speakers, rows)]) if rows else np.zeros(0, dtype=np.int8)
+        self._arrays = None
+
+    def __getstate__(self):
+        # Do not pickle open memmaps into DataLoader workers
+        state = self.__dict__.copy()
+        state['_arrays'] = None
+        return state
+
+    def _open(self):
+        self._arrays = {s: {field: load_field(self.features_dir, s, self.stored[s][field]) for field in self.fields}
+                        for s in self.speakers}
+
+    def __len__(self):
+        return len(self.speaker_index)
+
+    def __getitem__(self, idx):
+        if self._arrays is None:
+            self._open()
+        speaker = self.speakers[self.speaker_index[idx]]
+        row = self.row_index[idx]
+        sample = {field: torch.from_numpy(np.array(decode_field(self._arrays[speaker][field][row],
+                                                                self.field_info[speaker][field])))
+                  for field in self.fields}
+        sample['seg_label'] = int(self.labels[idx])
+        return sample
+
+
+class LRUByteCache():
+    '''
+    LRU cache of tuples of ndarrays, bounded by their total size in bytes.
+
+    max_bytes: memory budget of the in-memory tier, which is private to the process.
+    spill_dir: optional shared disk tier: every new entry is also written there as
+               .npz (write then rename) and a miss in memory reads it back, so the
+               entries are shared by all DataLoader workers and survive the workers
+               of previous epochs.
+    '''
+    def __init__(self, max_bytes, spill_dir=None):
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.hits, self.misses = 0, 0
+        if spill_dir is not None:
+            os.makedirs(spill_dir, exist_ok=True)
+
+    def _spill_path(self, key):
+        return os.path.join(self.spill_dir, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.npz')
+
+    def get(self, key):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key]
+        if self.spill_dir is not None and os.path.isfile(self._spill_path(key)):
+            with np.load(self._spill_path(key)) as fin:
+                value = tuple(fin[f'arr_{i}'] for i in range(len(fin.files)))
+            self.hits += 1
+            self._insert(key, value)
+            return value
+        self.misses += 1
+        return None
+
+    def put(self, key, value):
+        if key in self.entries:
+            return
+        if self.spill_dir is not None and not os.path.isfile(self._spill_path(key)):
+            path = self._spill_path(key)
+            tmp_path = f'{path}.{os.getpid()}.tmp'
+            with open(tmp_path, 'wb') as fout:
+                np.savez(fout, *value)
+            os.replace(tmp_path, path)
+        self._insert(key, value)
+
+    def _insert(self, key, value):
+        self.entries[key] = value
+        self.nbytes += sum(v.nbytes for v in value)
+        # Evict the least recently used entries, the disk tier keeps them
+        while self.nbytes > self.max_bytes and len(self.entries) > 1:
+            old_key, old_value = self.entries.popitem(last=False)
+            self.nbytes -= sum(v.nbytes for v in old_value)
+
+
+class OnlineFeatureDataset(Dataset):
+    '''
+    Segment-level dataset computing the features on first access.
+
+    speaker_files: get_files() of a database, {speaker_id: [(wav_path, label), ...]}.
+    features: key of GET_FEATURES, eg. 'logspec'.
+    params: same spectrogram parameters as run_extract_features.py.
+    speakers / exclude_speakers: leave-speaker-out selection.
+    cache_bytes: memory budget of the per-process LRU cache.
+    spill_dir: optional directory shared by all processes, see LRUByteCache.
+    snr: SNR version to return when params['snr_list'] is set (default: the first SNR).
+         All the versions are drawn as in the batch path, so the selected one matches
+         the stored --snr_list output.
+
+    The segment index is planned from the WAV headers only, so nothing is decoded
+    until a segment is requested. The whole utterance is extracted and cached on the
+    first request of any of its segments, keyed by its path, size and mtime.
+    The memory cache lives in each process: with num_workers > 0, DataLoader workers
+    do not share it, and a new DataLoader per epoch (make_dataloader) starts new
+    workers with empty caches. Set spill_dir so that later epochs and other workers
+    hit the cache; without it, use num_workers=0 or keep one DataLoader with
+    persistent workers across epochs. Two workers may still both compute an
+    utterance whose segments they request at the same time.
+    '''
+    def __init__(self, speaker_files, features, params, speakers=None, exclude_speakers=None,
+                 cache_bytes=2 * 1024**3, spill_dir=None, durations=None, snr=None):
+        # Index of the returned version in the list of extract_utterance with --snr_list
+        self.snr_index = None
+        if params.get('snr_list'):
+            version = params['snr_list'][0] if snr is None else snr
+            if version not in params['snr_list']:
+                raise ValueError(f'SNR {version} is not in snr_list {params["snr_list"]}')
+            self.snr_index = list(params['snr_list']).index(version)
+        elif snr is not None:
+            raise ValueError('snr requires params[\'snr_list\']')
+        if speakers is None:
+            speakers = list(speaker_files.keys())
+        if exclude_speakers is not None:
+            speakers = [s for s in speakers if s not in exclude_speakers]
+        self.speaker_files = {s: speaker_files[s] for s in speakers}
+        self.features = features
+        self.params = params
+        if durations is None:
+            durations = get_durations(self.speaker_files)
+        plan = plan_segments(self.speaker_files, durations, params)
+
+        # Global segment index -> (utterance, row)
+        self.utterances, counts = [], []
+        for speaker_id in self.speaker_files:
+            self.utterances.extend(self.speaker_files[speaker_id])
+            counts.extend(plan[speaker_id])
+        self.utter_index = np.repeat(np.arange(len(counts)), counts)
+        self.row_index = np.concatenate([np.arange(n) for n in counts]) if counts else np.zeros(0, dtype=np.int64)
+        self.labels = np.asarray([self.utterances[u][1] for u in self.utter_index], dtype=np.int8)
+
+        # The params that change the features are part of the cache key: the spill_dir
+        # tier outlives the run, so a new seed or SNR list must not hit the old entries
+        self.params_key = json.dumps({'features': features, 'snr': snr if self.snr_index is None
+                                      else params['snr_list'][self.snr_index],
+                                      **{k: params[k] for k in ('window', 'win_length', 'hop_length',
+                                                                'ndft', 'nfreq', 'nmel', 'segment_size')},
+                                      **{k: params.get(k) for k in ('seed', 'snr_list', 'mixnoise',
+                                                                    'stft_block')}},
+                                     sort_keys=True)
+        self.cache = LRUByteCache(cache_bytes, spill_dir)
+
+    def __len__(self):
+        return len(self.utter_index)
+
+    def get_utterance(self, u):
+        '''
+        Segmented (seg_spec, seg_mfcc, seg_audio) of utterance <u>, from the cache if possible.
+        '''
+        wav_path, emotion = self.utterances[u]
+        st = os.stat(wav_path)
+        key = f'{wav_path}|{st.st_size}|{st.st_mtime_ns}|{self.params_key}'
+        value = self.cache.get(key)
+        if value is None:
+            x, sr = load_audio(wav_path)
+            features_segmented = extract_utterance(x, sr, emotion, self.features, self.params,
+                                                   rng=utterance_rng(wav_path, self.params.get('seed', 111)))
+            if self.snr_index is not None:
+                features_segmented = features_segmented[self.snr_index]
+            value = (features_segmented[1], features_segmented[4], features_segmented[5])
+            self.cache.put(key, value)
+        return value
+
+    def __getitem__(self, idx):
+        seg_spec, seg_mfcc, seg_audio = self.get_utterance(self.utter_index[idx])
+        row = self.row_index[idx]
+        return {'seg_spec': torch.from_numpy(seg_spec[row].copy()),
+                'seg_mfcc': torch.from_numpy(seg_mfcc[row].copy()),
+                'seg_audio': torch.from_numpy(seg_audio[row].copy()),
+                'seg_label': int(self.labels[idx])}
+
+
+def make_dataloader(dataset, batch_size, shuffle=True, seed=111, epoch=0, num_workers=0, **kwargs):
+    '''
+    DataLoader with deterministic shuffling: the order depends only on (seed, epoch).
+    A new DataLoader per epoch starts new workers; per-process caches such as the
+    memory tier of OnlineFeatureDataset do not carry over (use its spill_dir).
+    '''
+    generator = torch.Generator()
+    generator.manual_seed(seed + epoch)
+    return DataLoader(dataset, batch_size=batch_size, shuffle=shuffle, generator=generator,
+                      num_workers=num_workers, persistent_workers=num_workers > 0, **kwargs)
@@ -0,0 +1,93 @@
+'''
+Author: Shihe Dong
+Description: Split and fold index files of the extracted features.
+The index stores segment ranges (rows of the per-speaker arrays), so any
+leave-one-speaker-out fold or fixed split is assembled from views of the
+stored arrays instead of copies.
+'''
+import json
+import numpy as np
+
+
+def utterance_ranges(seg_num):
+    '''
+    [start, end) rows of every utterance of a speaker, from its seg_num.
+    '''
+    offsets = np.concatenate([[0], np.cumsum(np.asarray(seg_num, dtype=np.int64))])
+    return [[int(offsets[i]), int(offsets[i + 1])] for i in range(len(seg_num))]
+
+
+def merge_ranges(ranges):
+    '''
+    Merge adjacent [start, end) ranges, so that contiguous rows give a single view.
+    '''
+    merged = []
+    for start, end in ranges:
+        if merged and merged[-1][1] == start:
+            merged[-1][1] = end
+        else:
+            merged.append([start, end])
+    return merged
+
+
+def build_index(features_data, speaker_files, dataset=None, database=None):
+    '''
+    Index of an extract_features output.
+
+    speakers: rows of every speaker and of each of its utterances
+    folds:    'loso': leave one speaker out, the others are train
+              'loso_session' (IEMOCAP): test one speaker, validate on the other
+                                        speaker of the same session
+    splits:   (MELD) official train/dev/test split -> {speaker: ranges}
+    '''
+    speakers = list(features_data.keys())
+    index = {'dataset': dataset, 'speakers': {}, 'folds': {}, 'splits': {}}
+    for speaker_id in speakers:
+        ranges = utterance_ranges(features_data[speaker_id]["seg_num"])
+        index['speakers'][speaker_id] = {'num_segments': ranges[-1][1] if ranges else 0,
+                                         'utterances': ranges}
+
+    index['folds']['loso'] = [{'test': [s], 'train': [t for t in speakers if t != s]} for s in speakers]
+    if dataset == 'IEMOCAP':
+        folds = []
+        for s in speakers:
+            val = [t for t in speakers if t != s and t[:-1] == s[:-1]]
+            folds.append({'test': [s], 'val': val, 'train': [t for t in speakers if t != s and t not in val]})
+        index['folds']['loso_session'] = folds
+
+    if database is not None and hasattr(database, 'get_split'):
+        splits = {}
+        for speaker_id in speakers:
+            ranges = index['speakers'][speaker_id]['utterances']
+            per_split = {}
+            for (wav_path, _), rows in zip(speaker_files[speaker_id], ranges):
+                per_split.setdefault(database.get_split(wav_path), []).append(list(rows))
+            for split, split_ranges in per_split.items():
+                splits.setdefault(split, {})[speaker_id] = merge_ranges(split_ranges)
+        index['splits'] = splits
+    return index
+
+
+def save_index(index, path):
+    with open(path, 'w', encoding='utf-8') as fout:
+        json.dump(index, fout)
+
+
+def load_index(path):
+    with open(path, 'r', encoding='utf-8') as fin:
+        return json.load(fin)
+
+
+def fold_ranges(index, speakers):
+    '''
+    Selection {speaker: ranges} of whole speakers, eg. fold_ranges(index, fold['train']).
+    '''
+    return {s: [[0, index['speakers'][s]['num_segments']]] for s in speakers}
+
+
+def take(features_data, selection, field):
+    '''
+    Views of <field> for a selection {speaker: ranges}. Slicing contiguous rows of
+    an array (or of a memmap from feature_store.load_feature_dir) does not copy.
+    '''
+    return [features_data[s][field][start:end] for s in selection for start, end in selection[s]]
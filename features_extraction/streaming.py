@@ -0,0 +1,216 @@
+'''
+Author: Shihe Dong
+Description: Streaming feature extraction for live audio.
+The same seg_spec/seg_mfcc/seg_audio as features_util.extract_utterance,
+computed incrementally from audio chunks.
+'''
+import sys
+import time
+import numpy as np
+import librosa
+
+from features_util import (FEATURE_BANK, load_audio, extract_utterance, segment_nd_features,
+                           StftFramer, DbAccumulator, segment_ranges, wav_segment_ranges,
+                           stft_block_supported)
+
+# Absolute tolerance (dB) of the final streaming output against the batch path.
+# The frames are computed chunk by chunk with float32 FFTs and einsum instead of
+# librosa's whole-signal calls, so the values differ by rounding only
+# (observed: ~2e-5 on seg_mfcc, ~8e-6 on logmelspec seg_spec).
+BATCH_ATOL = 1e-4
+
+
+class StreamingExtractor():
+    '''
+    Incremental version of features_util.extract_utterance for live audio.
+
+    features: 'logspec' or 'logmelspec'.
+    params: same spectrogram parameters as run_extract_features.py.
+    sr: sampling rate of the pushed chunks.
+    keep_history: keep every frame so that result() can return the whole utterance.
+                  If False, memory is bounded to about one segment.
+
+    push(chunk) returns the segments completed by the chunk as dicts with keys
+    'index', 'seg_spec' (C,F,T), 'seg_mfcc' (T,40) and 'seg_audio'.
+    The dB reference of seg_spec/seg_mfcc (ref=np.max, top_db=80) depends on the
+    whole utterance, so segments emitted before finish() use the maximum seen so
+    far. Segments emitted by finish(), and the output of result(), use the final
+    reference and match the batch path within BATCH_ATOL (not bit for bit).
+    '''
+    def __init__(self, features, params, sr=16000, keep_history=True, processor=None):
+        if features not in ('logspec', 'logmelspec'):
+            raise ValueError(f'Streaming extraction does not support <{features}> features')
+        if not stft_block_supported(sr, params):
+            raise ValueError(f'Streaming extraction needs a hop of 160 samples, got '
+                             f'{int((params["hop_length"]/1000) * sr)} at {sr} Hz')
+        self.features = features
+        self.params = params
+        self.sr = sr
+        self.keep_history = keep_history
+        self.segment_size = params['segment_size']
+        self.segment_size_wav = self.segment_size * 160
+        self.processor = processor if processor is not None else FEATURE_BANK.processor()
+
+        win_length = int((params['win_length']/1000) * sr)
+        hop_length = int((params['hop_length']/1000) * sr)
+        self.spec_framer = StftFramer(params['ndft'], hop_length, win_length,
+                                      FEATURE_BANK.window(params['window'], win_length))
+        if features == 'logspec':
+            self.spec_db = DbAccumulator(ref='max', keep_bins=params['nfreq'])
+        else:
+            self.mel_basis = FEATURE_BANK.mel(sr, params['ndft'], params['nmel'])
+            self.spec_db = DbAccumulator(ref='max')
+
+        # librosa.feature.mfcc(y, sr, n_mfcc=40, hop_length=160, htk=True)
+        self.mfcc_framer = StftFramer(2048, 160, window=FEATURE_BANK.window('hann', 2048))
+        self.mfcc_basis = FEATURE_BANK.mel(sr, 2048, 128, htk=True)
+        self.mfcc_db = DbAccumulator(ref=1.0)
+
+        self.zi = np.zeros(1, dtype=np.float32)
+        self.audio = []
+        self.audio_base = 0
+        self.num_samples = 0
+        self.num_emitted = 0
+        self.finished = False
+        self.latencies = []
+
+    def _add_spec(self, S):
+        if self.features == 'logspec':
+            # amplitude_to_db(ref=np.max) == power_to_db(ref=max power)
+            self.spec_db.push(np.square(np.abs(S)))
+        else:
+            power = np.abs(S) ** 2.0
+            self.spec_db.push(np.einsum("...ft,mf->...mt", power, self.mel_basis, optimize=True))
+
+    def _add_mfcc(self, S):
+        power = np.abs(S) ** 2.0
+        self.mfcc_db.push(np.einsum("...ft,mf->...mt", power, self.mfcc_basis, optimize=True))
+
+    def _audio(self, start, end):
+        audio = np.concatenate(self.audio) if len(self.audio) > 1 else self.audio[0]
+        self.audio = [audio]
+        return audio[start - self.audio_base:end - self.audio_base]
+
+    def _normalize(self, audio_pad):
+        audio_pad_pt = self.processor(audio_pad, sampling_rate=16000, return_tensors="pt").input_values
+        return audio_pad_pt.view(-1).cpu().detach().numpy()
+
+    def _segment(self, i, spec_range, wav_range):
+        start, end = spec_range
+        start_wav, end_wav = wav_range
+        seg_spec = np.zeros((1, self.spec_db.frames[0].shape[0], self.segment_size), dtype=np.float32)
+        seg_spec[0, :, :end - start] = self.spec_db.get(start, end)
+        seg_mfcc = np.zeros((self.segment_size, 40), dtype=np.float32)
+        seg_mfcc[:end - start] = (FEATURE_BANK.dct(128, 40) @ self.mfcc_db.get(start, end)).T
+        audio_pad = np.zeros(self.segment_size_wav, dtype=np.float32)
+        audio_pad[self.segment_size_wav - (end_wav - start_wav):] = self._audio(start_wav, end_wav)
+        return {'index': i, 'seg_spec': seg_spec, 'seg_mfcc': seg_mfcc,
+                'seg_audio': self._normalize(audio_pad)}
+
+    def _trim(self):
+        if self.keep_history:
+            return
+        # The last segment may reach back one segment before the emitted ones
+        start = max(0, (self.num_emitted - 1) * self.segment_size)
+        self.spec_db.trim(start)
+        self.mfcc_db.trim(start)
+        start_wav = max(0, (self.num_emitted - 1) * self.segment_size_wav)
+        if start_wav > self.audio_base and self.audio:
+            self.audio = [self._audio(start_wav, self.num_samples)]
+            self.audio_base = start_wav
+
+    def push(self, chunk):
+        '''
+        Process one chunk of audio and return the segments it completes.
+        '''
+        assert not self.finished, 'push() after finish()'
+        t0 = time.perf_counter()
+        x = np.asarray(chunk, dtype=np.float32)
+        # Pre-emphasis filter, with the filter state carried across chunks
+        y, self.zi = librosa.effects.preemphasis(x, zi=self.zi, return_zf=True)
+        self.audio.append(y)
+        self.num_samples += len(x)
+        self._add_spec(self.spec_framer.push(y))
+        self._add_mfcc(self.mfcc_framer.push(y))
+
+        # Emit the segments whose frames and samples are all available
+        complete = min(self.spec_db.total // self.segment_size,
+                       self.mfcc_db.total // self.segment_size,
+                       self.num_samples // self.segment_size_wav)
+        segments = []
+        for i in range(self.num_emitted, complete):
+            segments.append(self._segment(i, (i * self.segment_size, (i + 1) * self.segment_size),
+                                          (i * self.segment_size_wav, (i + 1) * self.segment_size_wav)))
+        self.num_emitted = max(self.num_emitted, complete)
+        self._trim()
+        self.latencies.append((len(x), time.perf_counter() - t0))
+        return segments
+
+    def finish(self):
+        '''
+        Flush the end of the stream and return the remaining segments.
+        '''
+        t0 = time.perf_counter()
+        empty = np.zeros(0, dtype=np.float32)
+        self._add_spec(self.spec_framer.push(empty, final=True))
+        self._add_mfcc(self.mfcc_framer.push(empty, final=True))
+        self.finished = True
+        assert self.spec_db.total == self.mfcc_db.total
+
+        spec_ranges = segment_ranges(self.spec_db.total, self.segment_size)
+        wav_ranges = wav_segment_ranges(self.num_samples, self.segment_size_wav, len(spec_ranges))
+
+        segments = [self._segment(i, spec_ranges[i], wav_ranges[i])
+                    for i in range(self.num_emitted, len(spec_ranges))]
+        self.num_emitted = len(spec_ranges)
+        self.latencies.append((0, time.perf_counter() - t0))
+        return segments
+
+    def result(self, emotion=None):
+        '''
+        Whole-utterance output in the segment_nd_features layout, with the final reference.
+        Equal to extract_utterance within BATCH_ATOL.
+        Requires keep_history=True and finish().
+        '''
+        assert self.keep_history and self.finished
+        spec = np.expand_dims(self.spec_db.get(0, self.spec_db.total), 0)
+        mfcc = (FEATURE_BANK.dct(128, 40) @ self.mfcc_db.get(0, self.mfcc_db.total)).T
+        return segment_nd_features(self._audio(0, self.num_samples), mfcc, spec, emotion, self.segment_size)
+
+    def latency_stats(self):
+        '''
+        Per-chunk processing time (seconds) and real-time factor.
+        '''
+        times = np.asarray([t for _, t in self.latencies])
+        samples = sum(n for n, _ in self.latencies)
+        return {'chunks': len(times),
+                'mean': float(times.mean()),
+                'p50': float(np.percentile(times, 50)),
+                'p95': float(np.percentile(times, 95)),
+                'max': float(times.max()),
+                'rtf': float(times.sum() / (samples / self.sr)) if samples else float('nan')}
+
+
+if __name__ == '__main__':
+    # Check against the batch path: python streaming.py <wav_path> [chunk_ms]
+    wav_path = sys.argv[1]
+    chunk_ms = float(sys.argv[2]) if len(sys.argv) > 2 else 100
+    params = {'window': 'hamming', 'win_length': 40, 'hop_length': 10,
+              'ndft': 800, 'nfreq': 200, 'nmel': 128, 'segment_size': 300}
+
+    x, sr = load_audio(wav_path)
+    chunk = int(chunk_ms / 1000 * sr)
+    for features in ('logspec', 'logmelspec'):
+        batch = extract_utterance(x, sr, 0, features, params)
+
+        extractor = StreamingExtractor(features, params, sr=sr)
+        for i in range(0, len(x), chunk):
+            extractor.push(x[i:i + chunk])
+        extractor.finish()
+        stream = extractor.result(0)
+
+        assert stream[0] == batch[0]
+        for name, k in (('seg_spec', 1), ('seg_mfcc', 4), ('seg_audio', 5)):
+            print(f'{features} {name:>10}: max abs diff {np.abs(stream[k] - batch[k]).max():.3e}')
+            np.testing.assert_allclose(stream[k], batch[k], rtol=0, atol=BATCH_ATOL, err_msg=f'{features} {name}')
+        print(f'{features} latency:', extractor.latency_stats())
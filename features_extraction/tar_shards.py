@@ -0,0 +1,181 @@
+'''
+Author: Shihe Dong
+Description: WebDataset-style tar shards of the extracted segments.
+Every sample is a group of tar members sharing one key:
+    <key>.seg_spec.npy, <key>.seg_mfcc.npy, <key>.seg_audio.npy, <key>.json
+where the JSON holds the labels and the speaker/utterance ids. Samples are
+written in a deterministic shuffled order into shards of fixed size, so
+training reads every shard sequentially and only shuffles the shard order.
+'''
+import io
+import os
+import json
+import tarfile
+import numpy as np
+import torch
+from torch.utils.data import IterableDataset, get_worker_info
+
+from feature_store import decode_field, field_info
+
+
+SHARDS_INDEX = 'shards.json'
+SHARD_FIELDS = ('seg_spec', 'seg_mfcc', 'seg_audio')
+
+
+def _add_member(tar, name, data):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mtime = 0   # reproducible shards
+    tar.addfile(info, io.BytesIO(data))
+
+
+def _npy_bytes(value):
+    buf = io.BytesIO()
+    np.save(buf, np.ascontiguousarray(value))
+    return buf.getvalue()
+
+
+def sample_order(features_data, seed=111):
+    '''
+    (speaker, row, utterance, segment, variant) of every sample, in a shuffled
+    order that only depends on <seed>.
+    '''
+    samples = []
+    for speaker_id, speaker_data in features_data.items():
+        num_variants = len(speaker_data['snr_list']) if 'snr_list' in speaker_data else 1
+        row = 0
+        for u, num_segs in enumerate(np.asarray(speaker_data['seg_num'], dtype=np.int64)):
+            for i in range(num_segs):
+                for v in range(num_variants):
+                    samples.append((speaker_id, row + i, u, i, v))
+            row += num_segs
+    order = np.random.default_rng(seed).permutation(len(samples))
+    return [samples[i] for i in order]
+
+
+def write_shards(features_data, speaker_files, out_dir, shard_size=1000, seed=111,
+                 fields=SHARD_FIELDS, manifest=None):
+    '''
+    Write the segments of an extract_features output into
+    <out_dir>/shard-000000.tar, ... with <shard_size> samples each, plus shards.json.
+
+    speaker_files: the get_files() the features were extracted from (utterance ids).
+    manifest: manifest of a feature directory, if <features_data> was loaded from one
+              without decoding (see feature_store.load_feature_dir).
+    '''
+    os.makedirs(out_dir, exist_ok=True)
+    samples = sample_order(features_data, seed)
+    shards = []
+    for start in range(0, len(samples), shard_size):
+        name = f'shard-{len(shards):06d}.tar'
+        with tarfile.open(os.path.join(out_dir, name), 'w') as tar:
+            for speaker_id, row, u, i, v in samples[start:start + shard_size]:
+                speaker_data = features_data[speaker_id]
+                wav_path = speaker_files[speaker_id][u][0]
+                utterance_id = os.path.splitext(os.path.basename(wav_path))[0]
+                key = f'{speaker_id}_{u:05d}_{i:03d}'.replace('.', '_')
+                label = {'speaker': str(speaker_id), 'utterance': utterance_id, 'utterance_index': u,
+                         'segment': i, 'seg_label': int(speaker_data['seg_label'][row]),
+                         'utter_label': int(speaker_data['utter_label'][u])}
+                if 'snr_list' in speaker_data:
+                    key += f'_v{v}'
+                    label['snr'] = float(speaker_data['snr_list'][v])
+                for field in fields:
+                    value = speaker_data[field]
+                    value = value[v][row] if 'snr_list' in speaker_data else value[row]
+                    if manifest is not None:
+                        value = decode_field(value, field_info(manifest, speaker_id, field))
+                    _add_member(tar, f'{key}.{field}.npy', _npy_bytes(value))
+                _add_member(tar, f'{key}.json', json.dumps(label).encode('utf-8'))
+        shards.append({'name': name, 'num_samples': min(shard_size, len(samples) - start)})
+
+    with open(os.path.join(out_dir, SHARDS_INDEX), 'w', encoding='utf-8') as fout:
+        json.dump({'seed': seed, 'shard_size': shard_size, 'fields': list(fields),
+                   'num_samples': len(samples), 'shards': shards}, fout, indent=2)
+    return shards
+
+
+def iterate_shard(path):
+    '''
+    Samples of one tar shard as dicts, reading the file strictly sequentially.
+    '''
+    sample, current = {}, None
+    with tarfile.open(path, 'r|') as tar:
+        for member in tar:
+            if not member.isfile():
+                continue
+            key, ext = member.name.split('.', 1)
+            if current is not None and key != current:
+                yield sample
+                sample = {}
+            current = key
+            data = tar.extractfile(member).read()
+            if ext == 'json':
+                sample.update(json.loads(data))
+            else:
+                sample[ext[:-len('.npy')]] = np.load(io.BytesIO(data))
+    if sample:
+        yield sample
+
+
+class TarShardDataset(IterableDataset):
+    '''
+    Streaming dataset over the shards written by write_shards.
+
+    shards_dir: directory with shards.json.
+    shuffle: shuffle the order of the shards every epoch, from (seed, epoch).
+    buffer_size: optional in-memory shuffle buffer of samples across shards
+                 (0: samples in the stored order, which is already shuffled).
+    speakers / exclude_speakers: leave-speaker-out selection, applied while streaming.
+
+    With DataLoader workers, each worker reads a disjoint subset of the shards.
+    '''
+    def __init__(self, shards_dir, shuffle=True, seed=111, buffer_size=0,
+                 speakers=None, exclude_speakers=None):
+        with open(os.path.join(shards_dir, SHARDS_INDEX), 'r', encoding='utf-8') as fin:
+            self.index = json.load(fin)
+        self.paths = [os.path.join(shards_dir, shard['name']) for shard in self.index['shards']]
+        self.fields = self.index['fields']
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+        self.buffer_size = buffer_size
+        self.speakers = set(speakers) if speakers is not None else None
+        self.exclude_speakers = set(exclude_speakers) if exclude_speakers is not None else set()
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _keep(self, sample):
+        speaker = sample['speaker']
+        return (self.speakers is None or speaker in self.speakers) and speaker not in self.exclude_speakers
+
+    def _to_torch(self, sample):
+        out = {field: torch.from_numpy(sample[field]) for field in self.fields}
+        out.update({k: v for k, v in sample.items() if k not in self.fields})
+        return out
+
+    def __iter__(self):
+        rng = np.random.default_rng(self.seed + self.epoch)
+        paths = [self.paths[i] for i in rng.permutation(len(self.paths))] if self.shuffle else list(self.paths)
+        worker = get_worker_info()
+        if worker is not None:
+            paths = paths[worker.id::worker.num_workers]
+            rng = np.random.default_rng([self.seed + self.epoch, worker.id])
+
+        buffer = []
+        for path in paths:
+            for sample in iterate_shard(path):
+                if not self._keep(sample):
+                    continue
+                if self.buffer_size <= 1:
+                    yield self._to_torch(sample)
+                    continue
+                buffer.append(sample)
+                if len(buffer) >= self.buffer_size:
+                    i = rng.integers(len(buffer))
+                    buffer[i], buffer[-1] = buffer[-1], buffer[i]
+                    yield self._to_torch(buffer.pop())
+        rng.shuffle(buffer)
+        for sample in buffer:
+            yield self._to_torch(sample)
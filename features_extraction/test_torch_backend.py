@@ -0,0 +1,72 @@
+'''
+Author: Shihe Dong
+Description: Equivalence of the torch backend with the librosa path.
+Run with: python -m pytest features_extraction
+'''
+import pytest
+
+np = pytest.importorskip('numpy')
+librosa = pytest.importorskip('librosa')
+torch = pytest.importorskip('torch')
+
+from features_util import GET_FEATURES, extract_utterance
+from torch_backend import batch_spectrogram, batch_mfcc, extract_batch
+
+PARAMS = {'window': 'hamming', 'win_length': 40, 'hop_length': 10,
+          'ndft': 800, 'nfreq': 200, 'nmel': 128, 'segment_size': 300}
+
+# Tolerance in dB of the torch backend against librosa (float32 FFTs)
+ATOL = 1e-2
+
+
+def make_signals(sr, durations=(0.4, 1.7, 3.0, 5.2)):
+    '''
+    Speech-like test signals: a harmonic sweep with amplitude modulation and noise,
+    preceded by near silence so that the top_db clipping is exercised.
+    '''
+    rng = np.random.default_rng(111)
+    xs = []
+    for d in durations:
+        t = np.arange(int(sr * d)) / sr
+        f0 = 120 + 80 * np.sin(2 * np.pi * 0.7 * t)
+        phase = 2 * np.pi * np.cumsum(f0) / sr
+        x = sum(np.sin(k * phase) / k for k in range(1, 8)) * (0.5 + 0.5 * np.sin(2 * np.pi * 3 * t))
+        x = 0.1 * x + 0.01 * rng.standard_normal(len(t))
+        x[:int(0.2 * sr)] *= 1e-3
+        xs.append(librosa.effects.preemphasis(x.astype(np.float32), zi=[0.0]))
+    return xs
+
+
+@pytest.mark.parametrize('features', ['logspec', 'logmelspec', 'logdeltaspec'])
+def test_batch_spectrogram(features, sr=16000):
+    xs = make_signals(sr)
+    with torch.inference_mode():
+        specs = batch_spectrogram(xs, sr, features, PARAMS)
+    for x, spec in zip(xs, specs):
+        ref = GET_FEATURES[features](x, sr, PARAMS)
+        assert spec.shape == ref.shape
+        np.testing.assert_allclose(spec, ref, rtol=0, atol=ATOL)
+
+
+@pytest.mark.parametrize('sr', [16000, 48000])
+def test_batch_mfcc(sr):
+    xs = make_signals(sr)
+    with torch.inference_mode():
+        mfccs = batch_mfcc(xs, sr)
+    for x, mfcc in zip(xs, mfccs):
+        ref = librosa.feature.mfcc(y=x, sr=sr, n_mfcc=40, hop_length=160, htk=True).T
+        assert mfcc.shape == ref.shape
+        np.testing.assert_allclose(mfcc, ref, rtol=0, atol=ATOL)
+
+
+def test_extract_batch_segments():
+    sr = 16000
+    xs = make_signals(sr)
+    emotions = list(range(len(xs)))
+    results = extract_batch(xs, sr, emotions, 'logspec', PARAMS)
+    for x, emotion, result in zip(xs, emotions, results):
+        ref = extract_utterance(x, sr, emotion, 'logspec', PARAMS)
+        assert result[0] == ref[0] and result[3] == ref[3]
+        np.testing.assert_allclose(result[1], ref[1], rtol=0, atol=ATOL)
+        np.testing.assert_allclose(result[4], ref[4], rtol=0, atol=ATOL)
+        np.testing.assert_allclose(result[5], ref[5], rtol=0, atol=1e-5)
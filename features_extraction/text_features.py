@@ -0,0 +1,66 @@
+'''
+Author: Shihe Dong
+Description: BERT text features of the MELD utterances.
+Tokenizes all the utterances in bulk with a fast tokenizer and runs a local BERT
+on CPU in length-sorted, dynamically padded batches.
+'''
+import numpy as np
+import torch
+from tqdm import tqdm
+from transformers import AutoTokenizer, BertModel
+
+
+def load_bert(model_path):
+    '''
+    Local fast tokenizer and BERT model in eval mode.
+    '''
+    tokenizer = AutoTokenizer.from_pretrained(model_path, use_fast=True)
+    model = BertModel.from_pretrained(model_path).eval()
+    return tokenizer, model
+
+
+def extract_text_features(texts, tokenizer, model, batch_size=64, max_length=128, pool='cls',
+                          num_threads=None):
+    '''
+    Pooled BERT embeddings of a list of texts, (N, H), in the order of <texts>.
+    pool: 'cls' for the pooler output, 'mean' for the mean of the token states.
+    '''
+    if num_threads:
+        torch.set_num_threads(num_threads)
+    # Tokenize everything at once, without padding
+    encoded = tokenizer(list(texts), truncation=True, max_length=max_length)
+    input_ids = encoded['input_ids']
+
+    # Length-sorted batches, each padded only to its own longest text
+    order = np.argsort([len(ids) for ids in input_ids], kind='stable')
+    embeddings = np.zeros((len(texts), model.config.hidden_size), dtype=np.float32)
+    with torch.inference_mode():
+        for i in tqdm(range(0, len(order), batch_size)):
+            rows = order[i:i + batch_size]
+            batch = tokenizer.pad({'input_ids': [input_ids[r] for r in rows]}, return_tensors='pt')
+            outputs = model(input_ids=batch['input_ids'], attention_mask=batch['attention_mask'])
+            if pool == 'cls':
+                pooled = outputs.pooler_output
+            else:
+                mask = batch['attention_mask'].unsqueeze(-1).to(outputs.last_hidden_state.dtype)
+                pooled = (outputs.last_hidden_state * mask).sum(dim=1) / mask.sum(dim=1)
+            embeddings[rows] = pooled.numpy()
+    return embeddings
+
+
+def add_text_features(features_data, speaker_texts, tokenizer, model, **kwargs):
+    '''
+    Add "utter_text" (N_utt, H) to every speaker of an extract_features output, in place.
+    The rows follow utter_label/seg_num, so segment j of utterance u uses row u.
+    speaker_texts: database.get_speaker_texts(database, speaker_files).
+    '''
+    speakers = list(features_data.keys())
+    texts = [text for speaker_id in speakers for text in speaker_texts[speaker_id]]
+    embeddings = extract_text_features(texts, tokenizer, model, **kwargs)
+    start = 0
+    for speaker_id in speakers:
+        n = len(speaker_texts[speaker_id])
+        assert n == len(features_data[speaker_id]["utter_label"])
+        features_data[speaker_id]["utter_text"] = embeddings[start:start + n]
+        start += n
+    return features_data
@@ -0,0 +1,156 @@
+'''
+Author: Shihe Dong
+Description: Batched CPU spectrogram backend in torch.
+Computes logspec/logmelspec/logdeltaspec and mfcc for several padded
+utterances in one call, then un-pads them.
+'''
+import sys
+import time
+import numpy as np
+import librosa
+import torch
+
+from features_util import FEATURE_BANK, GET_FEATURES, segment_nd_features, add_gaussian_noise_multi
+
+
+def _pad_batch(xs):
+    lengths = [len(x) for x in xs]
+    batch = torch.zeros(len(xs), max(lengths), dtype=torch.float32)
+    for i, x in enumerate(xs):
+        batch[i, :len(x)] = torch.from_numpy(np.asarray(x, dtype=np.float32))
+    return batch, lengths
+
+
+def stft_power(xs, n_fft, hop_length, win_length=None, window='hann'):
+    '''
+    |STFT|^2 of a list of 1-D signals, zero-padded into one batch.
+    Same framing as librosa.stft(center=True, pad_mode='constant').
+    Returns (B, F, T) power and the number of valid frames of each signal.
+    '''
+    batch, lengths = _pad_batch(xs)
+    win_length = n_fft if win_length is None else win_length
+    fft_window = torch.from_numpy(FEATURE_BANK.window(window, win_length).astype(np.float32))
+    S = torch.stft(batch, n_fft=n_fft, hop_length=hop_length, win_length=win_length,
+                   window=fft_window, center=True, pad_mode='constant', return_complex=True)
+    frames = [1 + n // hop_length for n in lengths]
+    return S.abs() ** 2, frames
+
+
+def power_to_db(power, frames, ref_max=True, amin=1e-10, top_db=80.0):
+    '''
+    librosa.power_to_db of every utterance of the batch, over its valid frames only.
+    ref_max: ref=np.max if True, else ref=1.0.
+    '''
+    mask = torch.arange(power.shape[-1])[None, :] < torch.tensor(frames)[:, None]   # (B, T)
+    mask = mask[:, None, :]
+    if ref_max:
+        ref_value = power.masked_fill(~mask, 0).amax(dim=(1, 2), keepdim=True)
+    else:
+        ref_value = torch.ones(power.shape[0], 1, 1)
+    log_spec = 10.0 * torch.log10(torch.clamp(power, min=amin))
+    log_spec = log_spec - 10.0 * torch.log10(torch.clamp(ref_value, min=amin))
+    if top_db is not None:
+        max_db = log_spec.masked_fill(~mask, -float('inf')).amax(dim=(1, 2), keepdim=True)
+        log_spec = torch.maximum(log_spec, max_db - top_db)
+    return log_spec
+
+
+def batch_spectrogram(xs, sr, features, params):
+    '''
+    Batched equivalent of GET_FEATURES[features](x, sr, params) for a list of signals.
+    Returns a list of (C, F, T) arrays.
+    '''
+    window        = params['window']
+    win_length    = int((params['win_length']/1000) * sr)
+    hop_length    = int((params['hop_length']/1000) * sr)
+    ndft          = params['ndft']
+
+    power, frames = stft_power(xs, ndft, hop_length, win_length, window)
+    if features == 'logmelspec':
+        mel_basis = torch.from_numpy(FEATURE_BANK.mel(sr, ndft, params['nmel']))
+        power = torch.matmul(mel_basis, power)
+        log_spec = power_to_db(power, frames)
+    else:
+        # amplitude_to_db(|S|, ref=np.max) == power_to_db(|S|^2, ref=max power)
+        log_spec = power_to_db(power, frames)[:, :params['nfreq']]
+
+    specs = []
+    for i, T in enumerate(frames):
+        spec = log_spec[i, :, :T].numpy()
+        if features == 'logdeltaspec':
+            spec = np.stack([spec, librosa.feature.delta(spec), librosa.feature.delta(spec, order=2)])
+        else:
+            spec = np.expand_dims(spec, 0)
+        specs.append(spec)
+    return specs
+
+
+def batch_mfcc(xs, sr, n_mfcc=40, hop_length=160):
+    '''
+    Batched equivalent of librosa.feature.mfcc(y=x, sr=sr, n_mfcc=40, hop_length=160, htk=True).T
+    '''
+    power, frames = stft_power(xs, 2048, hop_length)
+    mel_basis = torch.from_numpy(FEATURE_BANK.mel(sr, 2048, 128, htk=True))
+    log_mel = power_to_db(torch.matmul(mel_basis, power), frames, ref_max=False)
+    dct_basis = torch.from_numpy(FEATURE_BANK.dct(128, n_mfcc))
+    mfcc = torch.matmul(dct_basis, log_mel)
+    return [mfcc[i, :, :T].numpy().T for i, T in enumerate(frames)]
+
+
+def extract_batch(xs, sr, emotions, features, params, outs=None, rngs=None):
+    '''
+    Batched equivalent of features_util.extract_utterance for utterances of the same sr.
+    Returns the list of segment_nd_features tuples.
+    '''
+    if params.get('torch_threads'):
+        torch.set_num_threads(params['torch_threads'])
+    if outs is None:
+        outs = [None] * len(xs)
+    # Apply pre-emphasis filter
+    ys = [librosa.effects.preemphasis(x, zi = [0.0]) for x in xs]
+
+    # With params['snr_list'], every SNR version of every utterance goes in the same batch
+    snr_list = params.get('snr_list')
+    if snr_list:
+        num_variants = len(snr_list)
+        if rngs is None:
+            rngs = [None] * len(ys)
+        ys = [y for x, rng in zip(ys, rngs) for y in add_gaussian_noise_multi(x, snr_list, rng=rng)]
+        emotions = [emotion for emotion in emotions for _ in range(num_variants)]
+        outs = [o for out in outs for o in (out if out is not None else [None] * num_variants)]
+
+    with torch.inference_mode():
+        specs = batch_spectrogram(ys, sr, features, params)
+        mfccs = batch_mfcc(ys, sr)
+    results = [segment_nd_features(y, mfcc, spec, emotion, params['segment_size'], out=out)
+               for y, mfcc, spec, emotion, out in zip(ys, mfccs, specs, emotions, outs)]
+    if snr_list:
+        results = [results[i:i + num_variants] for i in range(0, len(results), num_variants)]
+    return results
+
+
+if __name__ == '__main__':
+    # Throughput per thread count (the equivalence with librosa is test_torch_backend.py):
+    #   python torch_backend.py [batch_size]
+    batch_size = int(sys.argv[1]) if len(sys.argv) > 1 else 16
+    params = {'window': 'hamming', 'win_length': 40, 'hop_length': 10,
+              'ndft': 800, 'nfreq': 200, 'nmel': 128, 'segment_size': 300}
+    sr = 16000
+    rng = np.random.default_rng(111)
+    xs = [librosa.effects.preemphasis((rng.standard_normal(int(sr * d)) * 0.1).astype(np.float32), zi=[0.0])
+          for d in rng.uniform(0.5, 8.0, batch_size)]
+
+    seconds = sum(len(x) for x in xs) / sr
+    for threads in sorted({1, 2, 4, torch.get_num_threads()}):
+        torch.set_num_threads(threads)
+        t0 = time.perf_counter()
+        with torch.inference_mode():
+            batch_spectrogram(xs, sr, 'logspec', params)
+            batch_mfcc(xs, sr)
+        torch_time = time.perf_counter() - t0
+        print(f'{threads:>3} threads: torch {seconds / torch_time:8.1f} s audio/s')
+    t0 = time.perf_counter()
+    for x in xs:
+        GET_FEATURES['logspec'](x, sr, params)
+        librosa.feature.mfcc(y=x, sr=sr, n_mfcc=40, hop_length=160, htk=True)
+    print(f'    librosa  {seconds / (time.perf_counter() - t0):8.1f} s audio/s')
@@ -0,0 +1,121 @@
+'''
+Author: Shihe Dong
+Description: wav2vec2 embeddings of seg_audio, computed once at extraction time.
+Runs a local wav2vec2 checkpoint on CPU in length-bucketed batches and stores
+the selected hidden layers next to the other fields as "seg_w2v".
+'''
+import os
+import hashlib
+import numpy as np
+import torch
+from tqdm import tqdm
+from transformers import Wav2Vec2Config, Wav2Vec2Model
+
+from features_util import WAV2VEC2_PATH, segment_valid_samples
+
+
+def load_wav2vec2(model_path=WAV2VEC2_PATH, tiny=False):
+    '''
+    Load a local wav2vec2 model in eval mode.
+    tiny: build a small randomly initialized model instead (offline tests).
+    '''
+    if tiny:
+        torch.manual_seed(0)
+        config = Wav2Vec2Config(hidden_size=32, num_hidden_layers=2, num_attention_heads=2,
+                                intermediate_size=64, conv_dim=(32, 32), conv_stride=(5, 4),
+                                conv_kernel=(10, 4), num_conv_pos_embeddings=16,
+                                num_conv_pos_embedding_groups=2)
+        config._name_or_path = 'tiny-random-wav2vec2'
+        model = Wav2Vec2Model(config)
+    else:
+        model = Wav2Vec2Model.from_pretrained(model_path)
+    return model.eval()
+
+
+def length_buckets(lengths, batch_size):
+    '''
+    Batches of row indices with similar lengths, longest first.
+    '''
+    order = np.argsort(-np.asarray(lengths), kind='stable')
+    return [order[i:i + batch_size] for i in range(0, len(order), batch_size)]
+
+
+def _cache_key(row, model_id, layers, pool):
+    h = hashlib.sha1()
+    h.update(f'{model_id}|{tuple(layers)}|{pool}|'.encode('utf-8'))
+    h.update(np.ascontiguousarray(row, dtype=np.float32).tobytes())
+    return h.hexdigest()
+
+
+def extract_wav2vec2(seg_audio, lengths, model, layers=(-1,), pool='mean', batch_size=16,
+                     num_threads=None, cache_dir=None):
+    '''
+    Hidden states of wav2vec2 for every row of seg_audio (N, samples).
+
+    lengths: number of valid samples of every row; the audio of a short segment
+             is padded at the front (see features_util.segment_valid_samples).
+
+    layers: indices into hidden_states (0 = CNN features projection, -1 = last layer).
+    pool: 'mean' averages over time -> (N, len(layers), H);
+          None keeps the frames -> (N, len(layers), T', H), padded rows cut to their length.
+    cache_dir: content-hash cache; rows already computed with the same model,
+               layers and pooling are read back instead of recomputed.
+    '''
+    if num_threads:
+        torch.set_num_threads(num_threads)
+    model_id = model.config._name_or_path
+    lengths = np.maximum(np.asarray(lengths, dtype=np.int64), 1)
+    results = [None] * len(seg_audio)
+
+    # Content-hash cache
+    keys = [None] * len(seg_audio)
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        for i, row in enumerate(seg_audio):
+            keys[i] = _cache_key(row[-lengths[i]:], model_id, layers, pool)
+            path = os.path.join(cache_dir, keys[i] + '.npy')
+            if os.path.isfile(path):
+                results[i] = np.load(path)
+    todo = np.asarray([i for i in range(len(seg_audio)) if results[i] is None], dtype=np.int64)
+
+    use_mask = model.config.feat_extract_norm == 'layer'
+    with torch.inference_mode():
+        for bucket in tqdm(length_buckets(lengths[todo], batch_size), disable=len(todo) == 0):
+            rows = todo[bucket]
+            max_len = int(lengths[rows].max())
+            batch = torch.zeros(len(rows), max_len)
+            mask = torch.zeros(len(rows), max_len, dtype=torch.long)
+            for j, i in enumerate(rows):
+                batch[j, :lengths[i]] = torch.from_numpy(np.ascontiguousarray(seg_audio[i, -lengths[i]:]))
+                mask[j, :lengths[i]] = 1
+            outputs = model(batch, attention_mask=mask if use_mask else None, output_hidden_states=True)
+            hidden = torch.stack([outputs.hidden_states[l] for l in layers], dim=1)   # (B, L, T', H)
+            frames = model._get_feat_extract_output_lengths(torch.as_tensor(lengths[rows]))
+            for j, i in enumerate(rows):
+                h = hidden[j, :, :int(frames[j])]
+                results[i] = (h.mean(dim=1) if pool == 'mean' else h).numpy().astype(np.float32)
+                if cache_dir is not None:
+                    np.save(os.path.join(cache_dir, keys[i] + '.npy'), results[i])
+
+    if pool == 'mean':
+        return np.stack(results)
+    return results
+
+
+def add_wav2vec2_features(features_data, model, speaker_files, durations, params, **kwargs):
+    '''
+    Add "seg_w2v" to every speaker of an extract_features output, in place.
+    speaker_files/durations/params: those of the extraction, to know the valid
+    samples of every segment. With --snr_list, seg_audio is a list and so is seg_w2v.
+    '''
+    for speaker_id in features_data:
+        seg_audio = features_data[speaker_id]["seg_audio"]
+        lengths = segment_valid_samples(speaker_files[speaker_id], features_data[speaker_id]["seg_num"],
+                                        durations, params)
+        if isinstance(seg_audio, list):
+            features_data[speaker_id]["seg_w2v"] = [extract_wav2vec2(np.asarray(a), lengths, model, **kwargs)
+                                                    for a in seg_audio]
+        else:
+            features_data[speaker_id]["seg_w2v"] = extract_wav2vec2(np.asarray(seg_audio), lengths, model,
+                                                                    **kwargs)
+    return features_data